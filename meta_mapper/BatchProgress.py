@@ -0,0 +1,168 @@
+"""
+    Track and display progress of a batch run: throughput, ETA, error counts and the
+    slowest directories.
+"""
+
+from collections import Counter
+import heapq
+import sys
+import time
+
+
+class BatchProgress:
+
+    """
+    Track and display progress of a batch run: throughput, ETA, error counts and the
+    slowest directories.
+    """
+
+    def __init__(self, total=None, stream=sys.stderr, interval=0.5, num_slowest=10, live=True):
+
+        """
+
+        Start the clock for a batch run.
+
+        Parameters:
+            total (int): Number of directories expected, or None if not known in advance.
+            stream (file): Where to write progress lines and the summary.
+            interval (float): Minimum number of seconds between live progress lines.
+            num_slowest (int): How many of the slowest directories to keep for the summary.
+            live (bool): Whether to write live progress lines at all.
+
+        """
+
+        self.total = total
+        self.stream = stream
+        self.interval = interval
+        self.num_slowest = num_slowest
+        self.live = live
+
+        self.start_time = time.monotonic()
+        self.last_render = 0.0
+        self.num_done = 0
+        self.num_ok = 0
+        self.error_counts = Counter()
+
+        # A min-heap of (elapsed, archive_dir), so the fastest of the slow ones is popped first.
+        self.slowest = []
+
+        # Overwrite a single line on a terminal; otherwise write one line per update.
+        self.line_end = '\r' if getattr(stream, "isatty", lambda: False)() else '\n'
+
+
+    def update(self, archive_dir, elapsed, error_type=None):
+
+        """
+
+        Record one finished directory and redraw the progress line if it's due.
+
+        Parameters:
+            archive_dir (str): The directory that was mapped.
+            elapsed (float): Seconds spent mapping it.
+            error_type (str): Short description of the error, or None if it mapped cleanly.
+
+        Returns: None
+
+        """
+
+        self.num_done += 1
+        if error_type:
+            self.error_counts[error_type] += 1
+        else:
+            self.num_ok += 1
+
+        if len(self.slowest) < self.num_slowest:
+            heapq.heappush(self.slowest, (elapsed, archive_dir))
+        elif self.slowest and elapsed > self.slowest[0][0]:
+            heapq.heapreplace(self.slowest, (elapsed, archive_dir))
+
+        now = time.monotonic()
+        if self.live and now - self.last_render >= self.interval:
+            self.last_render = now
+            self.stream.write(self.get_status_line() + self.line_end)
+            self.stream.flush()
+
+
+    def get_status_line(self):
+
+        """
+
+        Describe the progress so far in one line.
+
+        Parameters: None
+
+        Returns: (str): E.g. "1200/5000 dirs  85.3 dirs/s  ETA 0:00:44  errors: 12"
+
+        """
+
+        elapsed = time.monotonic() - self.start_time
+        rate = self.num_done / elapsed if elapsed > 0 else 0.0
+
+        if self.total:
+            status = f"{self.num_done}/{self.total} dirs  {rate:.1f} dirs/s"
+            if rate > 0:
+                status += f"  ETA {self.__format_seconds((self.total - self.num_done) / rate)}"
+        else:
+            status = f"{self.num_done} dirs  {rate:.1f} dirs/s"
+
+        status += f"  errors: {sum(self.error_counts.values())}"
+        return status
+
+
+    def write_summary(self):
+
+        """
+
+        Write the final counts, the error breakdown and the slowest directories.
+
+        Parameters: None
+
+        Returns: None
+
+        """
+
+        elapsed = time.monotonic() - self.start_time
+        rate = self.num_done / elapsed if elapsed > 0 else 0.0
+
+        lines = []
+        if self.live and self.line_end == '\r':
+            # Finish the live progress line before writing the summary under it.
+            lines.append("")
+        lines.append(f"Mapped {self.num_ok} of {self.num_done} directories in "
+                     f"{self.__format_seconds(elapsed)} ({rate:.1f} dirs/s)")
+
+        if self.error_counts:
+            lines.append("Errors:")
+            for error_type, count in self.error_counts.most_common():
+                lines.append(f"  {count:>8}  {error_type}")
+
+        if self.slowest:
+            lines.append("Slowest directories:")
+            for dir_elapsed, archive_dir in sorted(self.slowest, reverse=True):
+                lines.append(f"  {dir_elapsed:>8.2f}s  {archive_dir}")
+
+        self.stream.write('\n'.join(lines) + '\n')
+        self.stream.flush()
+
+
+
+    """
+
+    PRIVATE METHODS
+
+    """
+
+    def __format_seconds(self, seconds):
+
+        """
+
+        Format a number of seconds as H:MM:SS.
+
+        Parameters: seconds (float): The number of seconds.
+
+        Returns: (str): The formatted duration.
+
+        """
+
+        seconds = int(seconds)
+        return f"{seconds // 3600}:{seconds // 60 % 60:02d}:{seconds % 60:02d}"
@@ -0,0 +1,255 @@
+"""
+    Map many archive directories in parallel, streaming the results into a sink.
+"""
+
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, ThreadPoolExecutor, wait
+import json
+import time
+
+from meta_mapper.IoScheduler import SharedMountLimits
+from meta_mapper.MemoryProfiler import MemoryProfiler, MemoryReport
+from meta_mapper.MetaMapper import MetaMapper, get_config
+
+
+# Each worker process builds its own mapper once, then reuses it for every directory. With a
+# thread pool, every thread shares the one mapper.
+_worker_mapper = None
+
+# The memory profiler for this worker process, when profiling is on.
+_worker_profiler = None
+
+
+def _init_worker(mapper_kwargs=None, memory_profile=False):
+
+    """
+
+    Build the mapper used by this worker process, or by every thread of a thread pool.
+
+    Parameters:
+        mapper_kwargs (dict): Keyword arguments for the MetaMapper.
+        memory_profile (bool): Whether to profile memory while mapping.
+
+    Returns: None
+
+    """
+
+    global _worker_mapper, _worker_profiler
+    _worker_profiler = MemoryProfiler() if memory_profile else None
+    _worker_mapper = MetaMapper(memory_profiler=_worker_profiler, **(mapper_kwargs or {}))
+
+
+def _map_one(archive_dir, fields=None):
+
+    """
+
+    Map a single directory with this worker's mapper, timing the work.
+
+    Parameters:
+        archive_dir (str): Absolute path to a directory in the archive.
+        fields (list): Template keys to compute, or None for all of them.
+
+    Returns: (tuple): (archive_dir, new doc or error string, seconds elapsed,
+        memory record or None)
+
+    """
+
+    if _worker_profiler:
+        _worker_profiler.begin_directory(archive_dir)
+
+    start = time.perf_counter()
+    try:
+        result = _worker_mapper.create_new_document(archive_dir, fields=fields)
+    except Exception as e:
+        # Report the exception rather than losing the whole batch to one bad directory.
+        result = f"ERROR: {type(e).__name__}: {e}"
+    elapsed = time.perf_counter() - start
+
+    # End the directory while the result is still referenced, so it counts as retained.
+    memory_record = _worker_profiler.end_directory() if _worker_profiler else None
+    return archive_dir, result, elapsed, memory_record
+
+
+class BatchRunner:
+
+    """
+    Map many archive directories in parallel, streaming the results into a sink.
+    """
+
+    def __init__(self, sink, workers=1, progress=None, error_file=None, executor="process",
+                 mapper_kwargs=None, memory_profile=False, fields=None):
+
+        """
+
+        Parameters:
+            sink (ResultSink): Where mapped documents are written.
+            workers (int): Number of workers. With 1, directories are mapped in this process.
+            progress (BatchProgress): Progress tracker, or None for no reporting.
+            error_file (file): Open file to write one json line per failed directory, or None.
+            executor (str): "process" for a pool of processes, each with its own mapper, or
+                "thread" for a pool of threads sharing one mapper. Threads suit I/O-bound runs,
+                e.g. on network mounts, where the mapper mostly waits on the filesystem.
+            mapper_kwargs (dict): Keyword arguments for each MetaMapper. With worker processes,
+                they must be picklable.
+            memory_profile (bool): Profile memory per directory and per mapping stage, and
+                collect the results in self.memory_report. Profiling measures the whole process,
+                so it needs directories mapped one at a time in each process: not with more
+                than one thread.
+            fields (list): Template keys to compute for each directory, or None for all of them.
+
+        """
+
+        if executor not in ("process", "thread"):
+            raise ValueError(f"Unknown executor: {executor}")
+        if memory_profile and executor == "thread" and workers > 1:
+            raise ValueError("Memory profiling needs worker processes, not threads")
+
+        self.sink = sink
+        self.workers = max(1, workers)
+        self.progress = progress
+        self.error_file = error_file
+        self.executor = executor
+        self.mapper_kwargs = mapper_kwargs or {}
+        self.memory_profile = memory_profile
+        self.memory_report = MemoryReport() if memory_profile else None
+        self.fields = fields
+
+        # With a group snapshot, documents with lookups the snapshot couldn't answer are mapped
+        # without its version. Count them, so a snapshot that doesn't cover the batch is noticed.
+        self.snapshot_version_key = None
+        self.num_snapshot_misses = 0
+        if self.mapper_kwargs.get("group_snapshot"):
+            snapshot_version_key = get_config()["format"]["group_snapshot_version_key"]
+            if fields is None or snapshot_version_key in fields:
+                self.snapshot_version_key = snapshot_version_key
+
+        # Cap the number of directories queued up in the pool, so that a very long list
+        # of paths (e.g. from stdin) is streamed rather than read up front.
+        self.max_pending = self.workers * 4
+
+
+    def run(self, archive_dirs):
+
+        """
+
+        Map every directory and write the results.
+
+        Parameters: archive_dirs (iterable): Directory paths to map.
+
+        Returns: (int): The number of directories that failed to map.
+
+        """
+
+        self.num_failed = 0
+
+        if self.workers == 1:
+            _init_worker(self.mapper_kwargs, self.memory_profile)
+            for archive_dir in archive_dirs:
+                self.__handle_result(*_map_one(archive_dir, self.fields))
+            return self.num_failed
+
+        if self.executor == "thread":
+            # One warm mapper, built up front, serves every thread.
+            _init_worker(self.mapper_kwargs)
+            pool = ThreadPoolExecutor(max_workers=self.workers)
+        else:
+            # Each process has its own I/O scheduler. Share per-mount caps between them, so
+            # the pool as a whole keeps to each mount's limit.
+            mapper_kwargs = dict(self.mapper_kwargs)
+            mapper_kwargs.setdefault("shared_io_limits", SharedMountLimits(get_config()))
+            pool = ProcessPoolExecutor(max_workers=self.workers, initializer=_init_worker,
+                                       initargs=(mapper_kwargs, self.memory_profile))
+
+        with pool:
+            pending = set()
+            for archive_dir in archive_dirs:
+                if len(pending) >= self.max_pending:
+                    done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                    for future in done:
+                        self.__handle_result(*future.result())
+                pending.add(pool.submit(_map_one, archive_dir, self.fields))
+
+            for future in pending:
+                self.__handle_result(*future.result())
+
+        return self.num_failed
+
+
+    def get_io_stats(self):
+
+        """
+
+        Get the per-mount I/O stats of the mapper in this process. Each worker process has its
+        own mapper, so these are only available when mapping in this process or with threads.
+
+        Parameters: None
+
+        Returns: (dict): Stats keyed by mount point, or None if mapping was done in other processes.
+
+        """
+
+        if _worker_mapper is None or (self.executor == "process" and self.workers > 1):
+            return None
+        return _worker_mapper.io_scheduler.get_stats()
+
+
+    def get_memo_stats(self):
+
+        """
+
+        Get the memo hits and misses of the mapper in this process. As with get_io_stats(),
+        these are only available when mapping in this process or with threads.
+
+        Parameters: None
+
+        Returns: (dict): From MappingMemo.get_stats(), or None if not available.
+
+        """
+
+        if _worker_mapper is None or _worker_mapper.memo is None:
+            return None
+        if self.executor == "process" and self.workers > 1:
+            return None
+        return _worker_mapper.memo.get_stats()
+
+
+
+    """
+
+    PRIVATE METHODS
+
+    """
+
+    def __handle_result(self, archive_dir, result, elapsed, memory_record=None):
+
+        """
+
+        Send a mapped document to the sink, or record the error.
+
+        Parameters:
+            archive_dir (str): The directory that was mapped.
+            result (dict or str): The new document, or an error string starting with "ERROR".
+            elapsed (float): Seconds spent mapping the directory.
+            memory_record (dict): The directory's memory record, if profiling.
+
+        Returns: None
+
+        """
+
+        if memory_record:
+            self.memory_report.add(memory_record)
+
+        error_type = None
+        if isinstance(result, str):
+            self.num_failed += 1
+
+            # Group errors by type, without the detail that varies from one directory to the next.
+            error_type = result.split(':')[1].strip() if ':' in result else result
+            if self.error_file:
+                self.error_file.write(json.dumps({"archive_dir": archive_dir, "error": result}) + '\n')
+        else:
+            if self.snapshot_version_key and self.snapshot_version_key not in result:
+                self.num_snapshot_misses += 1
+            self.sink.write(archive_dir, result)
+
+        if self.progress:
+            self.progress.update(archive_dir, elapsed, error_type)
@@ -0,0 +1,135 @@
+"""
+    Estimate how expensive each directory in a batch will be to map, and order the batch so
+    that the expensive ones start first.
+"""
+
+import json
+import statistics
+
+
+class CostEstimator:
+
+    """
+    Estimate how expensive each directory in a batch will be to map, and order the batch so
+    that the expensive ones start first.
+
+    Most of the time spent mapping a directory is the du walk that measures its archived size,
+    which grows with the size of the tree. A few multi-terabyte deliveries can take longer than
+    thousands of small directories, and if one of them is picked up last, the whole batch waits
+    on one worker. Dispatching the most expensive directories first (longest processing time
+    first) lets the small ones fill in around them.
+    """
+
+    def __init__(self, config, archived_sizes=None, crawl_stats=None):
+
+        """
+
+        Parameters:
+            config (ConfigParser): The meta_mapper config.
+            archived_sizes (dict): Archived sizes in bytes from a previous run, keyed by path.
+            crawl_stats (dict): (entry_count, metadata_bytes) tuples from a crawl, keyed by path.
+
+        """
+
+        settings = config["scheduling"]
+        self.seconds_per_byte = settings.getfloat("seconds_per_archived_byte")
+        self.seconds_per_entry = settings.getfloat("seconds_per_entry")
+        self.seconds_per_metadata_byte = settings.getfloat("seconds_per_metadata_byte")
+
+        self.archived_sizes = archived_sizes or {}
+        self.crawl_stats = crawl_stats or {}
+
+
+    def estimate(self, archive_dir):
+
+        """
+
+        Estimate the cost of mapping a directory, in rough seconds.
+
+        Parameters: archive_dir (str): A directory in the archive.
+
+        Returns: (float): The estimated cost, or None if nothing is known about the directory.
+
+        """
+
+        cost = None
+
+        # A previously measured size is the best guide to how long du will take.
+        archived_size = self.archived_sizes.get(archive_dir)
+        if archived_size is not None:
+            cost = archived_size * self.seconds_per_byte
+
+        entry_count, metadata_bytes = self.crawl_stats.get(archive_dir, (None, None))
+        if entry_count is not None:
+            # Without a known size, the number of entries is a stand-in for the size of the tree.
+            if cost is None:
+                cost = entry_count * self.seconds_per_entry
+            cost += metadata_bytes * self.seconds_per_metadata_byte
+
+        return cost
+
+
+    def order(self, archive_dirs):
+
+        """
+
+        Order directories for dispatch: the most expensive first, with the cheapest interleaved
+        between them so results keep flowing while the big ones run.
+
+        Parameters: archive_dirs (list): Directory paths to map.
+
+        Returns: (list): The same paths, reordered. If nothing is known about any of them,
+            they're left in their input order.
+
+        """
+
+        costs = {archive_dir: self.estimate(archive_dir) for archive_dir in archive_dirs}
+
+        known_costs = [cost for cost in costs.values() if cost is not None]
+        if not known_costs:
+            return list(archive_dirs)
+
+        # Directories we know nothing about are assumed to be typical.
+        typical_cost = statistics.median(known_costs)
+
+        by_cost = sorted(archive_dirs,
+                         key=lambda archive_dir: costs[archive_dir] if costs[archive_dir] is not None
+                                                 else typical_cost,
+                         reverse=True)
+
+        # Alternate between the expensive end and the cheap end of the list.
+        ordered = []
+        low, high = 0, len(by_cost) - 1
+        while low <= high:
+            ordered.append(by_cost[low])
+            low += 1
+            if low <= high:
+                ordered.append(by_cost[high])
+                high -= 1
+        return ordered
+
+
+def read_archived_sizes(jsonl_filename, path_field="archived_path", size_field="archived_size"):
+
+    """
+
+    Read the archived sizes recorded in a previous run's jsonl output.
+
+    Parameters:
+        jsonl_filename (str): Output of a previous (non-delta) run.
+        path_field (str): The document field holding the archived path.
+        size_field (str): The document field holding the archived size.
+
+    Returns: (dict): Sizes in bytes, keyed by archived path.
+
+    """
+
+    archived_sizes = {}
+    with open(jsonl_filename) as f:
+        for line in f:
+            if not line.strip():
+                continue
+            doc = json.loads(line)
+            if doc.get(path_field) and isinstance(doc.get(size_field), int):
+                archived_sizes[doc[path_field]] = doc[size_field]
+    return archived_sizes
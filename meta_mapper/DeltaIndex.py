@@ -0,0 +1,287 @@
+"""
+    Compare newly mapped documents against those from a previous run, so that only new
+    documents and changed fields need to be written downstream.
+"""
+
+import hashlib
+import json
+import sqlite3
+
+from meta_mapper.ResultSink import ResultSink
+
+
+def get_doc_hash(doc):
+
+    """
+
+    Get a cheap, stable hash of a document's contents.
+
+    Parameters: doc (dict): A mapped document.
+
+    Returns: (str): Hex digest that is equal for documents with equal contents.
+
+    """
+
+    doc_json = json.dumps(doc, sort_keys=True, separators=(',', ':'))
+    return hashlib.blake2b(doc_json.encode("utf-8"), digest_size=16).hexdigest()
+
+
+class DeltaIndex:
+
+    """
+    A local lookup of previously mapped documents, keyed by archived path, that reports what
+    changed in each newly mapped document.
+    """
+
+    def __init__(self, index_filename, key_field="archived_path"):
+
+        """
+
+        Open (or create) the index.
+
+        Parameters:
+            index_filename (str): SQLite file holding the index.
+            key_field (str): The document field that identifies a document across runs.
+
+        """
+
+        self.key_field = key_field
+        self.conn = sqlite3.connect(index_filename)
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS docs (key TEXT PRIMARY KEY, doc_hash TEXT, doc TEXT)")
+        self.num_uncommitted = 0
+
+
+    def load_previous_run(self, jsonl_filename):
+
+        """
+
+        Add every document in a previous run's jsonl output to the index.
+
+        Parameters: jsonl_filename (str): Output of a previous (non-delta) run.
+
+        Returns: (int): Number of documents loaded.
+
+        """
+
+        num_loaded = 0
+        with open(jsonl_filename) as f:
+            rows = []
+            for line in f:
+                if not line.strip():
+                    continue
+                doc = json.loads(line)
+                if not doc.get(self.key_field):
+                    # Without a key, there's nothing to match the document against later.
+                    continue
+                rows.append((doc.get(self.key_field), get_doc_hash(doc), json.dumps(doc)))
+                if len(rows) >= 10000:
+                    num_loaded += self.__insert_rows(rows)
+                    rows = []
+            num_loaded += self.__insert_rows(rows)
+
+        self.conn.commit()
+        return num_loaded
+
+
+    def get_delta(self, key, new_doc):
+
+        """
+
+        Compare a new document with the indexed one, and record the new one in the index.
+        The change is only saved by commit(), which should wait until the document has been
+        stored downstream; otherwise a failed write would leave it looking unchanged next run.
+
+        Parameters:
+            key (str): The document's key, normally its archived path.
+            new_doc (dict): The newly mapped document.
+
+        Returns: (dict): None if the document is unchanged. Otherwise either
+            {"op": "insert", <key_field>: key, "doc": new_doc} for a document not seen before, or
+            {"op": "update", <key_field>: key, "set": {changed fields}, "unset": [removed fields]}.
+
+        """
+
+        new_hash = get_doc_hash(new_doc)
+        row = self.conn.execute("SELECT doc_hash FROM docs WHERE key = ?", (key,)).fetchone()
+
+        # Most documents don't change between runs. Matching hashes let us skip loading and
+        # comparing the stored document.
+        if row and row[0] == new_hash:
+            return None
+
+        old_doc_json = None
+        if row:
+            old_doc_json = self.conn.execute("SELECT doc FROM docs WHERE key = ?", (key,)).fetchone()[0]
+
+        self.conn.execute("INSERT OR REPLACE INTO docs VALUES (?, ?, ?)",
+                          (key, new_hash, json.dumps(new_doc)))
+        self.num_uncommitted += 1
+
+        if old_doc_json is None:
+            return {"op": "insert", self.key_field: key, "doc": new_doc}
+
+        old_doc = json.loads(old_doc_json)
+        changed = {k: v for k, v in new_doc.items() if k not in old_doc or old_doc[k] != v}
+        removed = [k for k in old_doc if k not in new_doc]
+        return {"op": "update", self.key_field: key, "set": changed, "unset": removed}
+
+
+    def get_archived_sizes(self, size_field="archived_size"):
+
+        """
+
+        Get the archived size of every indexed document.
+
+        Parameters: size_field (str): The document field holding the archived size.
+
+        Returns: (dict): Sizes in bytes, keyed by archived path. Documents without a size are left out.
+
+        """
+
+        # Parse the documents here rather than with json_extract(), which needs SQLite's JSON1
+        # extension.
+        archived_sizes = {}
+        for key, doc_json in self.conn.execute("SELECT key, doc FROM docs"):
+            size = json.loads(doc_json).get(size_field)
+            if type(size) == int:
+                archived_sizes[key] = size
+        return archived_sizes
+
+
+    def commit(self):
+
+        """
+
+        Save any pending changes to the index.
+
+        Parameters: None
+
+        Returns: None
+
+        """
+
+        self.conn.commit()
+        self.num_uncommitted = 0
+
+
+    def close(self, commit=True):
+
+        """
+
+        Close the index.
+
+        Parameters: commit (bool): Save pending changes first. If False, they're discarded.
+
+        Returns: None
+
+        """
+
+        if commit:
+            self.commit()
+        self.conn.close()
+
+
+
+    """
+
+    PRIVATE METHODS
+
+    """
+
+    def __insert_rows(self, rows):
+
+        """
+
+        Insert or replace (key, hash, doc) rows in the index.
+
+        Parameters: rows (list): Tuples of (key, doc_hash, doc json).
+
+        Returns: (int): Number of rows inserted.
+
+        """
+
+        self.conn.executemany("INSERT OR REPLACE INTO docs VALUES (?, ?, ?)", rows)
+        return len(rows)
+
+
+class DeltaSink(ResultSink):
+
+    """
+    Wrap another sink so that it only receives new documents and patches for changed ones.
+
+    Changes are only committed to the index once the wrapped sink has confirmed it stored them,
+    so a failed write is sent again by the next run instead of being lost.
+    """
+
+    def __init__(self, sink, delta_index, commit_interval=10000):
+
+        """
+
+        Parameters:
+            sink (ResultSink): Where insert and update records are written.
+            delta_index (DeltaIndex): The index of previously mapped documents.
+            commit_interval (int): Number of changed documents after which the wrapped sink is
+                flushed and the index committed.
+
+        """
+
+        self.sink = sink
+        self.delta_index = delta_index
+        self.commit_interval = commit_interval
+        self.num_inserted = 0
+        self.num_updated = 0
+        self.num_unchanged = 0
+
+
+    def write(self, archive_dir, new_doc):
+
+        # Documents are matched on their archived path. Fall back to the directory we mapped.
+        key = new_doc.get(self.delta_index.key_field) or archive_dir
+        delta = self.delta_index.get_delta(key, new_doc)
+
+        if delta is None:
+            self.num_unchanged += 1
+            return
+
+        if delta["op"] == "insert":
+            self.num_inserted += 1
+        else:
+            self.num_updated += 1
+        self.sink.write(archive_dir, delta)
+
+        if self.delta_index.num_uncommitted >= self.commit_interval:
+            self.flush()
+
+
+    def flush(self):
+        self.sink.flush()
+        self.delta_index.commit()
+
+
+    def close(self):
+
+        try:
+            self.sink.close()
+        except BaseException:
+            # Some changes since the last commit may not have been stored. Forget all of them,
+            # so the next run sends them again.
+            self.delta_index.close(commit=False)
+            raise
+        self.delta_index.close()
+
+
+    def get_summary(self):
+
+        """
+
+        Describe how many documents were new, changed and unchanged.
+
+        Parameters: None
+
+        Returns: (str): One line summary.
+
+        """
+
+        return (f"Delta: {self.num_inserted} new, {self.num_updated} changed, "
+                f"{self.num_unchanged} unchanged")
@@ -0,0 +1,186 @@
+"""
+    Find directories to be mapped, either by crawling a root directory or by reading
+    directory paths from files or stdin.
+"""
+
+from collections import deque
+import os
+import sys
+
+
+class DirectoryCrawler:
+
+    """
+    Find directories to be mapped, either by crawling a root directory or by reading
+    directory paths from files or stdin.
+    """
+
+    def __init__(self, config):
+
+        """
+
+        Save the metadata filenames to look for while crawling.
+
+        Parameters: config (ConfigParser): The meta_mapper config.
+
+        """
+
+        # The doc_names section lists every metadata filename the mapper will read. A
+        # directory holding any one of them is worth mapping.
+        self.dirname_key = config["format"]["dirname_key"]
+        self.doc_filenames = set()
+        self.dirname_suffixes = set()
+        for doc_filename in config["doc_names"].values():
+            if doc_filename.startswith(self.dirname_key):
+                # The filename includes the directory name, so we can only match the rest of it.
+                self.dirname_suffixes.add(doc_filename[len(self.dirname_key):])
+            else:
+                self.doc_filenames.add(doc_filename)
+
+
+    def crawl(self, root_dir):
+
+        """
+
+        Walk a directory tree, yielding every directory that holds a metadata document.
+
+        A directory is yielded once its whole subtree has been walked, so that its entry count
+        is complete, but directories are still yielded in the order they were found.
+
+        Parameters: root_dir (str): The directory to start crawling from.
+
+        Returns: Generator of (archive_dir, entry_count, metadata_bytes) tuples, where
+            entry_count is the number of entries anywhere below the directory, and
+            metadata_bytes is the total size of its metadata docs.
+
+        """
+
+        # Directories holding metadata, in the order they were found, waiting for their
+        # subtrees to be counted.
+        found = deque()
+
+        stack = [(root_dir, None)]
+        while stack:
+            curr_dir, parent = stack.pop()
+            node = _CrawlNode(curr_dir, parent)
+            try:
+                with os.scandir(curr_dir) as it:
+                    entries = list(it)
+            except OSError:
+                # Unreadable directories are skipped, not fatal.
+                entries = []
+
+            basedir = os.path.basename(os.path.normpath(curr_dir))
+            dirname_filenames = {basedir + suffix for suffix in self.dirname_suffixes}
+            has_metadata = False
+            sub_dirs = []
+            for entry in entries:
+                if entry.is_dir(follow_symlinks=False):
+                    sub_dirs.append(entry.path)
+                elif entry.name in self.doc_filenames or entry.name in dirname_filenames:
+                    has_metadata = True
+                    try:
+                        node.metadata_bytes += entry.stat().st_size
+                    except OSError:
+                        pass
+
+            node.entry_count = len(entries)
+            node.num_unfinished = len(sub_dirs)
+            if has_metadata:
+                found.append(node)
+            if not sub_dirs:
+                node.finish()
+
+            while found and found[0].finished:
+                done = found.popleft()
+                yield done.path, done.entry_count, done.metadata_bytes
+
+            # Keep the output in a stable, sorted order.
+            stack.extend((sub_dir, node) for sub_dir in sorted(sub_dirs, reverse=True))
+
+
+    def read_paths(self, filenames):
+
+        """
+
+        Read directory paths, one per line, from the given files. A filename of '-' means stdin.
+
+        Parameters: filenames (list): Files holding directory paths.
+
+        Returns: Generator of directory paths as strings.
+
+        """
+
+        for filename in filenames:
+            if filename == '-':
+                yield from self.__paths_from_lines(sys.stdin)
+                continue
+
+            with open(filename) as f:
+                yield from self.__paths_from_lines(f)
+
+
+
+    """
+
+    PRIVATE METHODS
+
+    """
+
+    def __paths_from_lines(self, lines):
+
+        """
+
+        Yield each non-blank, non-comment line as a directory path.
+
+        Parameters: lines (iterable): Lines of text.
+
+        Returns: Generator of directory paths as strings.
+
+        """
+
+        for line in lines:
+            path = line.strip()
+            if path and not path.startswith('#'):
+                yield path
+
+
+class _CrawlNode:
+
+    """
+    A directory being crawled, whose entry count grows as its subdirectories are finished.
+    """
+
+    def __init__(self, path, parent):
+        self.path = path
+        self.parent = parent
+        self.entry_count = 0
+        self.metadata_bytes = 0
+        self.num_unfinished = 0
+        self.finished = False
+
+
+    def finish(self):
+
+        """
+
+        Mark the directory's subtree as fully counted, adding its entries to its parent's, and
+        finishing the parent too if this was the last of its subdirectories.
+
+        Parameters: None
+
+        Returns: None
+
+        """
+
+        node = self
+        while node:
+            node.finished = True
+            parent = node.parent
+            if parent is None:
+                return
+            parent.entry_count += node.entry_count
+            parent.num_unfinished -= 1
+            if parent.num_unfinished:
+                return
+            node = parent
@@ -0,0 +1,301 @@
+"""
+    An offline, memory-mapped snapshot of the group, user and lab lookups the mapper makes
+    through the SystemGroupsFinder.
+
+    A snapshot is built by mapping directories with a RecordingGroupsFinder wrapped around the
+    live SystemGroupsFinder, which records every lookup and its answer. SnapshotGroupsFinder then
+    answers the same lookups from the snapshot file, with no directory services involved. The
+    file is opened with mmap, so processes on a machine share one copy of it in the page cache.
+
+    File layout:
+        magic (8 bytes)
+        header length (uint32) and header (json: snapshot version, creation time, entry count)
+        entries: (key digest (16 bytes), value offset (uint64), value length (uint32)), sorted by digest
+        values: json, one per entry
+"""
+
+from datetime import datetime
+import hashlib
+import json
+import mmap
+import struct
+import threading
+
+
+SNAPSHOT_MAGIC = b"MMGSNAP1"
+ENTRY_STRUCT = struct.Struct("<16sQI")
+HEADER_LEN_STRUCT = struct.Struct("<I")
+
+
+def get_lookup_digest(method_name, *args):
+
+    """
+
+    Get the key under which a lookup is stored in a snapshot.
+
+    Key order in dict arguments is kept, not sorted, as in MappingMemo.get_doc_digest: group
+    lookups scan a doc in order, so two docs that differ only in key order can get different
+    answers.
+
+    Parameters:
+        method_name (str): The SystemGroupsFinder method called.
+        *args: The arguments it was called with.
+
+    Returns: (bytes): 16 byte digest of the method name and arguments. Raises TypeError if an
+        argument isn't json, since it couldn't be matched reliably.
+
+    """
+
+    try:
+        key = method_name + '\0' + json.dumps(args, separators=(',', ':'))
+    except TypeError as e:
+        raise TypeError(f"Can't snapshot {method_name} lookup with non-json arguments: {e}") from e
+    return hashlib.blake2b(key.encode("utf-8"), digest_size=16).digest()
+
+
+def write_snapshot(filename, lookups, snapshot_version):
+
+    """
+
+    Write a snapshot file.
+
+    Parameters:
+        filename (str): The file to write.
+        lookups (dict): Json strings of lookup results, keyed by digest from get_lookup_digest().
+        snapshot_version (str): Version recorded in the snapshot and in documents mapped with it.
+
+    Returns: None
+
+    """
+
+    header = json.dumps({
+        "snapshot_version": snapshot_version,
+        "created": datetime.now().isoformat(timespec="seconds"),
+        "num_entries": len(lookups),
+    }).encode("utf-8")
+
+    entries = []
+    values = []
+    offset = 0
+    for digest in sorted(lookups):
+        value = lookups[digest].encode("utf-8")
+        entries.append(ENTRY_STRUCT.pack(digest, offset, len(value)))
+        values.append(value)
+        offset += len(value)
+
+    with open(filename, "wb") as f:
+        f.write(SNAPSHOT_MAGIC)
+        f.write(HEADER_LEN_STRUCT.pack(len(header)))
+        f.write(header)
+        f.write(b"".join(entries))
+        f.write(b"".join(values))
+
+
+class RecordingGroupsFinder:
+
+    """
+    Wrap a SystemGroupsFinder, passing lookups through to it and recording every answer so they
+    can be written to a snapshot.
+    """
+
+    def __init__(self, system_groups_finder):
+
+        """
+
+        Parameters: system_groups_finder (SystemGroupsFinder): The live finder to wrap.
+
+        """
+
+        self.system_groups_finder = system_groups_finder
+        self.lookups = {}
+        self.lock = threading.Lock()
+
+
+    def get_other_info_from_group(self, key, val, target_key):
+        return self.__record("get_other_info_from_group", key, val, target_key)
+
+
+    def get_groups_from_entire_doc(self, doc):
+        return self.__record("get_groups_from_entire_doc", doc)
+
+
+    def search_archived_path_for_group_name(self, archived_path, target_key):
+        return self.__record("search_archived_path_for_group_name", archived_path, target_key)
+
+
+    def write(self, filename, snapshot_version):
+
+        """
+
+        Write everything recorded so far to a snapshot file.
+
+        Parameters:
+            filename (str): The file to write.
+            snapshot_version (str): Version to record in the snapshot.
+
+        Returns: (int): Number of lookups written.
+
+        """
+
+        with self.lock:
+            lookups = dict(self.lookups)
+        write_snapshot(filename, lookups, snapshot_version)
+        return len(lookups)
+
+
+
+    """
+
+    PRIVATE METHODS
+
+    """
+
+    def __record(self, method_name, *args):
+
+        """
+
+        Call a method of the live finder and record the answer.
+
+        Parameters:
+            method_name (str): The SystemGroupsFinder method to call.
+            *args: Arguments for the method.
+
+        Returns: Whatever the live finder returned.
+
+        """
+
+        digest = get_lookup_digest(method_name, *args)
+        result = getattr(self.system_groups_finder, method_name)(*args)
+        result_json = json.dumps(result)
+        with self.lock:
+            self.lookups[digest] = result_json
+        return result
+
+
+class SnapshotGroupsFinder:
+
+    """
+    Answer SystemGroupsFinder lookups from a snapshot file, without using directory services.
+
+    Lookups are matched on their exact arguments, so only lookups made while the snapshot was
+    recorded can be answered. Others are misses, and return None, as the live finder does when
+    it finds nothing. Misses are counted per thread, so the mapper can tell which documents
+    weren't fully answered by the snapshot.
+    """
+
+    def __init__(self, filename):
+
+        """
+
+        Map the snapshot file into memory and read its header.
+
+        Parameters: filename (str): A file written by write_snapshot().
+
+        """
+
+        with open(filename, "rb") as f:
+            self.mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+        if self.mm[:len(SNAPSHOT_MAGIC)] != SNAPSHOT_MAGIC:
+            raise ValueError(f"Not a group snapshot file: {filename}")
+
+        try:
+            pos = len(SNAPSHOT_MAGIC)
+            header_len, = HEADER_LEN_STRUCT.unpack_from(self.mm, pos)
+            pos += HEADER_LEN_STRUCT.size
+            self.header = json.loads(self.mm[pos:pos + header_len])
+            pos += header_len
+
+            self.snapshot_version = self.header["snapshot_version"]
+            self.num_entries = self.header["num_entries"]
+        except (struct.error, ValueError, KeyError, TypeError) as e:
+            raise ValueError(f"Bad header in group snapshot file {filename}: {e}") from e
+
+        self.entries_start = pos
+        self.values_start = pos + self.num_entries * ENTRY_STRUCT.size
+
+        # Every value must lie within the file. Checking the last one catches a truncated file.
+        if self.values_start > len(self.mm):
+            raise ValueError(f"Group snapshot file is truncated: {filename}")
+        if self.num_entries:
+            _, offset, length = ENTRY_STRUCT.unpack_from(self.mm, self.values_start - ENTRY_STRUCT.size)
+            if self.values_start + offset + length > len(self.mm):
+                raise ValueError(f"Group snapshot file is truncated: {filename}")
+
+        self.num_misses = 0
+        self.lock = threading.Lock()
+        self.local = threading.local()
+
+
+    def get_other_info_from_group(self, key, val, target_key):
+        return self.__lookup("get_other_info_from_group", key, val, target_key)
+
+
+    def get_groups_from_entire_doc(self, doc):
+        return self.__lookup("get_groups_from_entire_doc", doc)
+
+
+    def search_archived_path_for_group_name(self, archived_path, target_key):
+        return self.__lookup("search_archived_path_for_group_name", archived_path, target_key)
+
+
+    def get_thread_misses(self):
+
+        """
+
+        Get the number of misses in the calling thread so far. Compare the numbers from before
+        and after mapping a document to tell whether its lookups all hit.
+
+        Parameters: None
+
+        Returns: (int): Misses in this thread.
+
+        """
+
+        return getattr(self.local, "num_misses", 0)
+
+
+    def close(self):
+        self.mm.close()
+
+
+
+    """
+
+    PRIVATE METHODS
+
+    """
+
+    def __lookup(self, method_name, *args):
+
+        """
+
+        Binary search the snapshot's sorted entries for a lookup.
+
+        Parameters:
+            method_name (str): The SystemGroupsFinder method being answered.
+            *args: The arguments it was called with.
+
+        Returns: The recorded answer, or None if the lookup isn't in the snapshot.
+
+        """
+
+        digest = get_lookup_digest(method_name, *args)
+
+        low, high = 0, self.num_entries
+        while low < high:
+            mid = (low + high) // 2
+            entry_digest, offset, length = ENTRY_STRUCT.unpack_from(
+                self.mm, self.entries_start + mid * ENTRY_STRUCT.size)
+            if entry_digest < digest:
+                low = mid + 1
+            elif entry_digest > digest:
+                high = mid
+            else:
+                start = self.values_start + offset
+                return json.loads(self.mm[start:start + length])
+
+        self.local.num_misses = self.get_thread_misses() + 1
+        with self.lock:
+            self.num_misses += 1
+        return None
@@ -0,0 +1,582 @@
+"""
+    Route filesystem work through per-mount concurrency limits that adapt to each mount's
+    observed latency and error rate.
+"""
+
+import fcntl
+import mmap
+import os
+import shutil
+import struct
+import tempfile
+import threading
+import time
+import weakref
+
+
+# A mount's shared limit and the time it was last cut, in a SharedMountLimits state file.
+SHARED_STATE_STRUCT = struct.Struct("<dd")
+
+
+def get_adjusted_limit(limit, last_decrease, latency, ok, min_limit, max_limit, target_latency):
+
+    """
+
+    Adjust a concurrency limit after an operation (additive increase, multiplicative decrease).
+
+    Parameters:
+        limit (float): The current limit.
+        last_decrease (float): time.monotonic() when the limit was last cut.
+        latency (float): Seconds the operation took.
+        ok (bool): False if the operation raised an error.
+        min_limit (int): The limit never drops below this.
+        max_limit (int): The limit never rises above this.
+        target_latency (float): Seconds. Slower operations cause the limit to be cut.
+
+    Returns: (tuple): The new (limit, last_decrease).
+
+    """
+
+    if not ok or latency > target_latency:
+        # Halve the limit, but only once per target_latency period, so that a burst of
+        # slow operations that were all in flight together counts as one signal.
+        now = time.monotonic()
+        if now - last_decrease >= target_latency:
+            return max(min_limit, limit / 2), now
+        return limit, last_decrease
+
+    # Add roughly one slot per limit's worth of healthy operations.
+    return min(max_limit, limit + 1 / limit), last_decrease
+
+
+class AdaptiveLimiter:
+
+    """
+    A counting semaphore whose limit adapts to observed latency and errors (additive increase,
+    multiplicative decrease). A fast, healthy mount earns more concurrent operations; a slow or
+    failing one is backed off before it browns out.
+    """
+
+    def __init__(self, initial_limit, min_limit, max_limit, target_latency):
+
+        """
+
+        Parameters:
+            initial_limit (int): Number of concurrent operations to start with.
+            min_limit (int): The limit never drops below this.
+            max_limit (int): The limit never rises above this.
+            target_latency (float): Seconds. Slower operations cause the limit to be cut.
+
+        """
+
+        self.min_limit = min_limit
+        self.max_limit = max_limit
+        self.target_latency = target_latency
+        self.limit = float(min(max(initial_limit, min_limit), max_limit))
+
+        self.cond = threading.Condition()
+        self.in_flight = 0
+        self.num_completed = 0
+        self.num_errors = 0
+        self.avg_latency = 0.0
+        self.last_decrease = 0.0
+
+
+    def acquire(self):
+        with self.cond:
+            while self.in_flight >= int(self.limit):
+                self.cond.wait()
+            self.in_flight += 1
+
+
+    def release(self, latency, ok):
+
+        """
+
+        Free a slot, and adjust the limit based on how the operation went.
+
+        Parameters:
+            latency (float): Seconds the operation took.
+            ok (bool): False if the operation raised an error.
+
+        Returns: None
+
+        """
+
+        with self.cond:
+            self.in_flight -= 1
+            self.num_completed += 1
+            self.avg_latency += (latency - self.avg_latency) * 0.1
+
+            if not ok:
+                self.num_errors += 1
+
+            self.limit, self.last_decrease = get_adjusted_limit(
+                self.limit, self.last_decrease, latency, ok,
+                self.min_limit, self.max_limit, self.target_latency)
+
+            self.cond.notify_all()
+
+
+    def get_stats(self):
+        with self.cond:
+            return {
+                "limit": int(self.limit),
+                "in_flight": self.in_flight,
+                "completed": self.num_completed,
+                "errors": self.num_errors,
+                "avg_latency": round(self.avg_latency, 4),
+            }
+
+
+class SharedMountLimits:
+
+    """
+    Caps on concurrent operations per mount that hold across processes. Each process's
+    IoScheduler only sees its own operations, so without these a pool of N processes puts
+    N times the configured limit on every mount.
+
+    Each slot is a lock file in a temporary directory, held with flock(), so the slots of a
+    process that dies, e.g. killed for running out of memory, are freed by the kernel. A
+    mount's operation limit is shared too, and adapts to the latency and errors seen by every
+    process, the same way AdaptiveLimiter does within one process. Walks have a fixed limit.
+
+    Create one before starting the processes (a process pool, or forked workers), and pass it
+    to the IoScheduler in each of them. The directory is removed when the creating process is
+    done with it.
+    """
+
+    def __init__(self, config):
+
+        """
+
+        Create the slot directory, and a state file with the starting limit of each configured
+        mount, and of paths not under any of them.
+
+        Parameters: config (ConfigParser): The meta_mapper config.
+
+        """
+
+        settings = config["io_scheduler"]
+        self.min_limit = settings.getint("min_concurrency")
+        self.max_limit = settings.getint("max_concurrency")
+        self.target_latency = settings.getfloat("target_latency")
+        self.walk_limit = settings.getint("walk_concurrency")
+
+        initial_limits = {mount: int(limit) for mount, limit in config["io_mounts"].items()}
+        initial_limits[os.sep] = settings.getint("default_concurrency")
+
+        # Mount points don't make good filenames, so files are named by each mount's position.
+        self.mount_ids = {mount: i for i, mount in enumerate(initial_limits)}
+
+        self.directory = tempfile.mkdtemp(prefix="meta_mapper_limits_")
+        for mount, limit in initial_limits.items():
+            limit = min(max(limit, self.min_limit), self.max_limit)
+            with open(self.__get_state_filename(mount), "wb") as f:
+                f.write(SHARED_STATE_STRUCT.pack(float(limit), 0.0))
+
+        # Only the creating process removes the directory, not the processes that inherit it.
+        weakref.finalize(self, _remove_limits_directory, self.directory, os.getpid())
+
+        self.__init_process()
+
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        for key in ("pid", "lock", "files", "held", "states"):
+            state.pop(key, None)
+        return state
+
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.__init_process()
+
+
+    def acquire(self, mount, walk=False):
+
+        """
+
+        Wait for a free slot on a mount.
+
+        Parameters:
+            mount (str): A mount point from IoScheduler.get_mount().
+            walk (bool): True for a walk slot, False for an operation slot.
+
+        Returns: (int): The slot taken. Pass it to release().
+
+        """
+
+        self.__check_process()
+        delay = 0.001
+        while True:
+            limit = self.walk_limit if walk else int(self.get_limit(mount))
+            with self.lock:
+                for slot in range(limit):
+                    key = (mount, walk, slot)
+                    if key in self.held:
+                        # flock() can't tell this process's threads apart, so track them here.
+                        continue
+                    try:
+                        fcntl.flock(self.__get_slot_file(key), fcntl.LOCK_EX | fcntl.LOCK_NB)
+                    except BlockingIOError:
+                        continue
+                    self.held.add(key)
+                    return slot
+
+            time.sleep(delay)
+            delay = min(delay * 2, 0.05)
+
+
+    def release(self, mount, slot, walk=False, latency=None, ok=True):
+
+        """
+
+        Free a slot, and for an operation slot, adjust the mount's shared limit based on how
+        the operation went.
+
+        Parameters:
+            mount (str): The mount the slot is on.
+            slot (int): The slot from acquire().
+            walk (bool): True for a walk slot, False for an operation slot.
+            latency (float): Seconds the operation took, or None to leave the limit alone.
+            ok (bool): False if the operation raised an error.
+
+        Returns: None
+
+        """
+
+        key = (mount, walk, slot)
+        with self.lock:
+            fcntl.flock(self.files[key], fcntl.LOCK_UN)
+            self.held.discard(key)
+
+        if walk or latency is None:
+            return
+
+        state_file, state = self.__get_state(mount)
+        fcntl.flock(state_file, fcntl.LOCK_EX)
+        try:
+            limit, last_decrease = SHARED_STATE_STRUCT.unpack_from(state)
+            limit, last_decrease = get_adjusted_limit(
+                limit, last_decrease, latency, ok, self.min_limit, self.max_limit, self.target_latency)
+            SHARED_STATE_STRUCT.pack_into(state, 0, limit, last_decrease)
+        finally:
+            fcntl.flock(state_file, fcntl.LOCK_UN)
+
+
+    def get_limit(self, mount):
+
+        """
+
+        Get a mount's current shared limit on concurrent operations.
+
+        Parameters: mount (str): A mount point from IoScheduler.get_mount().
+
+        Returns: (float): The limit.
+
+        """
+
+        self.__check_process()
+        _, state = self.__get_state(mount)
+        return SHARED_STATE_STRUCT.unpack_from(state)[0]
+
+
+
+    """
+
+    PRIVATE METHODS
+
+    """
+
+    def __check_process(self):
+
+        """
+
+        Reopen the files if this is a process forked since they were opened. A forked process
+        shares its parent's open files, and with them the parent's locks.
+
+        Parameters: None
+
+        Returns: None
+
+        """
+
+        if self.pid != os.getpid():
+            self.__init_process()
+
+
+    def __get_slot_file(self, key):
+
+        """
+
+        Get the open lock file of a slot, opening it on first use. The caller must hold self.lock.
+
+        Parameters: key (tuple): (mount, walk, slot).
+
+        Returns: (file): The lock file.
+
+        """
+
+        if key not in self.files:
+            mount, walk, slot = key
+            kind = "walk" if walk else "op"
+            filename = os.path.join(self.directory, f"{self.mount_ids[mount]}.{kind}.{slot}")
+            self.files[key] = open(filename, "a")
+        return self.files[key]
+
+
+    def __get_state(self, mount):
+
+        """
+
+        Get a mount's open state file and its memory map, opening them on first use.
+
+        Parameters: mount (str): A mount point from IoScheduler.get_mount().
+
+        Returns: (tuple): (file, mmap).
+
+        """
+
+        with self.lock:
+            if mount not in self.states:
+                state_file = open(self.__get_state_filename(mount), "r+b")
+                self.states[mount] = (state_file, mmap.mmap(state_file.fileno(), SHARED_STATE_STRUCT.size))
+            return self.states[mount]
+
+
+    def __get_state_filename(self, mount):
+        return os.path.join(self.directory, f"{self.mount_ids[mount]}.state")
+
+
+    def __init_process(self):
+
+        """
+
+        Set up the files and locks used by this process.
+
+        Parameters: None
+
+        Returns: None
+
+        """
+
+        self.pid = os.getpid()
+        self.lock = threading.Lock()
+        self.files = {}
+        self.held = set()
+        self.states = {}
+
+
+def _remove_limits_directory(directory, owner_pid):
+
+    """
+
+    Remove a SharedMountLimits directory, if called in the process that created it.
+
+    Parameters:
+        directory (str): The directory.
+        owner_pid (int): The creating process.
+
+    Returns: None
+
+    """
+
+    if os.getpid() == owner_pid:
+        shutil.rmtree(directory, ignore_errors=True)
+
+
+class IoScheduler:
+
+    """
+    Route filesystem work through per-mount concurrency limits that adapt to each mount's
+    observed latency and error rate.
+
+    Walks of whole trees (du) have a separate, fixed limit per mount. They take as long as the
+    tree is big, so they would hold on to the slots that quick reads and stats need, and their
+    latency says nothing about the health of the mount.
+    """
+
+    def __init__(self, config, shared_limits=None):
+
+        """
+
+        Read the mounts and tuning settings from the config.
+
+        Parameters:
+            config (ConfigParser): The meta_mapper config.
+            shared_limits (SharedMountLimits): Limits shared with the other processes of a pool,
+                or None if this process is the only one mapping.
+
+        """
+
+        settings = config["io_scheduler"]
+        self.min_limit = settings.getint("min_concurrency")
+        self.max_limit = settings.getint("max_concurrency")
+        self.default_limit = settings.getint("default_concurrency")
+        self.target_latency = settings.getfloat("target_latency")
+        self.walk_limit = settings.getint("walk_concurrency")
+        self.shared_limits = shared_limits
+
+        # Each mount's value is its starting concurrency. Check the longest mount points first,
+        # so /cifs/x/y wins over /cifs/x.
+        self.initial_limits = {mount: int(limit) for mount, limit in config["io_mounts"].items()}
+        self.mounts = sorted(self.initial_limits, key=len, reverse=True)
+
+        self.limiters = {}
+        self.walk_limiters = {}
+        self.lock = threading.Lock()
+
+
+    def run(self, path, func, *args, **kwargs):
+
+        """
+
+        Call func once a slot is free on the mount holding the given path.
+
+        Parameters:
+            path (str): The path func will touch. Used to pick the mount.
+            func (callable): The I/O to do.
+            *args, **kwargs: Passed on to func.
+
+        Returns: Whatever func returns. Exceptions from func are passed on, and count as errors
+            for the mount.
+
+        """
+
+        mount = self.get_mount(path)
+        limiter = self.__get_limiter(mount)
+
+        limiter.acquire()
+        if self.shared_limits:
+            slot = self.shared_limits.acquire(mount)
+        start = time.monotonic()
+        ok = False
+        try:
+            result = func(*args, **kwargs)
+            ok = True
+            return result
+        finally:
+            latency = time.monotonic() - start
+            if self.shared_limits:
+                self.shared_limits.release(mount, slot, latency=latency, ok=ok)
+            limiter.release(latency, ok)
+
+
+    def run_walk(self, path, func, *args, **kwargs):
+
+        """
+
+        Call func, a walk of a whole tree such as du, once a walk slot is free on the mount
+        holding the given path. Walks don't take slots from other operations, and don't tune
+        the mount's limit.
+
+        Parameters:
+            path (str): The path func will walk. Used to pick the mount.
+            func (callable): The walk to do.
+            *args, **kwargs: Passed on to func.
+
+        Returns: Whatever func returns. Exceptions from func are passed on.
+
+        """
+
+        mount = self.get_mount(path)
+        walk_limiter = self.__get_walk_limiter(mount)
+
+        with walk_limiter:
+            if self.shared_limits:
+                slot = self.shared_limits.acquire(mount, walk=True)
+            try:
+                return func(*args, **kwargs)
+            finally:
+                if self.shared_limits:
+                    self.shared_limits.release(mount, slot, walk=True)
+
+
+    def get_mount(self, path):
+
+        """
+
+        Find which configured mount a path is on.
+
+        Parameters: path (str): An absolute path.
+
+        Returns: (str): The configured mount point, or os.sep if the path isn't under any of them.
+
+        """
+
+        for mount in self.mounts:
+            if path == mount or path.startswith(mount.rstrip(os.sep) + os.sep):
+                return mount
+        return os.sep
+
+
+    def get_stats(self):
+
+        """
+
+        Get the current limit and counters for every mount used so far. With shared limits,
+        the limit is the one shared by the pool, and the counters are this process's.
+
+        Parameters: None
+
+        Returns: (dict): Stats for each mount, keyed by mount point.
+
+        """
+
+        with self.lock:
+            limiters = dict(self.limiters)
+        stats = {mount: limiter.get_stats() for mount, limiter in limiters.items()}
+        if self.shared_limits:
+            for mount, mount_stats in stats.items():
+                mount_stats["limit"] = int(self.shared_limits.get_limit(mount))
+        return stats
+
+
+
+    """
+
+    PRIVATE METHODS
+
+    """
+
+    def __get_limiter(self, mount):
+
+        """
+
+        Get the limiter for a mount, creating it on first use.
+
+        Parameters: mount (str): A mount point from get_mount().
+
+        Returns: (AdaptiveLimiter): The mount's limiter.
+
+        """
+
+        limiter = self.limiters.get(mount)
+        if limiter:
+            return limiter
+
+        with self.lock:
+            if mount not in self.limiters:
+                initial_limit = self.initial_limits.get(mount, self.default_limit)
+                self.limiters[mount] = AdaptiveLimiter(
+                    initial_limit, self.min_limit, self.max_limit, self.target_latency)
+            return self.limiters[mount]
+
+
+    def __get_walk_limiter(self, mount):
+
+        """
+
+        Get the semaphore limiting walks on a mount, creating it on first use.
+
+        Parameters: mount (str): A mount point from get_mount().
+
+        Returns: (BoundedSemaphore): The mount's walk semaphore.
+
+        """
+
+        with self.lock:
+            if mount not in self.walk_limiters:
+                self.walk_limiters[mount] = threading.BoundedSemaphore(self.walk_limit)
+            return self.walk_limiters[mount]
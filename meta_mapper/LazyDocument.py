@@ -0,0 +1,104 @@
+"""
+    A mapped document whose fields are computed only when they're read.
+"""
+
+from collections.abc import Mapping
+
+
+class LazyDocument(Mapping):
+
+    """
+    A read-only mapping of template keys to values, where each value is computed the first time
+    it's read, and kept. Only the work needed for the fields actually read is ever done.
+
+    Reading fields one at a time repeats some shared work for each one. To get several fields,
+    or the whole document, use get_fields() or to_dict(), which compute them together.
+
+    Not safe to share between threads.
+    """
+
+    def __init__(self, field_names, build, optional_fields=()):
+
+        """
+
+        Parameters:
+            field_names (list): Every field the document can have, in order.
+            build (callable): Given a list of field names, returns a dict with just those fields,
+                leaving out any optional field the document turns out not to have.
+            optional_fields (list): Fields the document may turn out not to have. Checking for
+                one, or iterating over the document, computes it.
+
+        """
+
+        self.field_names = list(field_names)
+        self.build = build
+        self.optional_fields = frozenset(optional_fields)
+        self.values = {}
+        self.absent = set()
+
+
+    def __getitem__(self, key):
+        if key not in self.values:
+            if key not in self.field_names:
+                raise KeyError(key)
+            self.get_fields([key])
+            if key not in self.values:
+                raise KeyError(key)
+        return self.values[key]
+
+
+    def __contains__(self, key):
+        # Checking for a key shouldn't compute its value, unless the document may not have it.
+        if key in self.optional_fields:
+            self.get_fields([key])
+            return key in self.values
+        return key in self.field_names
+
+
+    def __iter__(self):
+        self.get_fields(self.optional_fields)
+        return (key for key in self.field_names if key not in self.absent)
+
+
+    def __len__(self):
+        self.get_fields(self.optional_fields)
+        return len(self.field_names) - len(self.absent)
+
+
+    def get_fields(self, fields):
+
+        """
+
+        Get several fields, computing the ones not yet read together.
+
+        Parameters: fields (list): Field names.
+
+        Returns: (dict): The requested fields and their values. Optional fields the document
+            doesn't have are left out.
+
+        """
+
+        missing = [key for key in fields if key not in self.values and key not in self.absent]
+        if missing:
+            unknown = [key for key in missing if key not in self.field_names]
+            if unknown:
+                raise KeyError(unknown[0])
+            built = self.build(missing)
+            self.values.update(built)
+            self.absent.update(key for key in missing if key not in built)
+        return {key: self.values[key] for key in fields if key in self.values}
+
+
+    def to_dict(self):
+
+        """
+
+        Compute every field not yet read, and return the whole document.
+
+        Parameters: None
+
+        Returns: (dict): The document, the same as the mapper's create_new_document() would build.
+
+        """
+
+        return self.get_fields(self.field_names)
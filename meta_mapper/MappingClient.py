@@ -0,0 +1,159 @@
+"""
+    A thin client for the mapping service. It only uses the standard library, so it starts
+    quickly from shell scripts.
+
+    Example:
+        $ meta-mapper-client --socket /run/meta_mapper.sock /archive/GT/2020/x > x.json
+"""
+
+import argparse
+import json
+import socket
+import sys
+
+
+class MappingClient:
+
+    """
+    A connection to a running mapping service. One connection can carry any number of requests.
+    """
+
+    def __init__(self, socket_path, timeout=None):
+
+        """
+
+        Connect to the service.
+
+        Parameters:
+            socket_path (str): Path of the service's Unix-domain socket.
+            timeout (float): Seconds to wait for each response, or None to wait indefinitely.
+
+        """
+
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.settimeout(timeout)
+        self.sock.connect(socket_path)
+        self.reader = self.sock.makefile("rb")
+
+
+    def create_new_document(self, archive_dir, fields=None):
+
+        """
+
+        Map a directory in the archive.
+
+        Parameters:
+            archive_dir (str): Absolute path to a directory in the archive.
+            fields (list): Template keys to compute, or None for all of them.
+
+        Returns:
+            new_doc (dict): New metadata document, OR error string starting with "ERROR"
+
+        """
+
+        request = {"path": archive_dir}
+        if fields is not None:
+            request["fields"] = list(fields)
+        return self.__request(request)
+
+
+    def create_new_document_from_given_doc(self, old_doc):
+
+        """
+
+        Map an existing metadata document.
+
+        Parameters: old_doc (dict): The existing metadata dict
+
+        Returns:
+            new_doc (dict): New metadata document, OR error string starting with "ERROR"
+
+        """
+
+        return self.__request({"doc": old_doc})
+
+
+    def close(self):
+        self.reader.close()
+        self.sock.close()
+
+
+    def __enter__(self):
+        return self
+
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+
+
+    """
+
+    PRIVATE METHODS
+
+    """
+
+    def __request(self, request):
+
+        """
+
+        Send one request and wait for its response.
+
+        Parameters: request (dict): The request.
+
+        Returns: The mapped document, or an error string starting with "ERROR".
+
+        """
+
+        self.sock.sendall(json.dumps(request).encode("utf-8") + b'\n')
+        line = self.reader.readline()
+        if not line:
+            return "ERROR: the mapping service closed the connection"
+
+        response = json.loads(line)
+        if response["ok"]:
+            return response["doc"]
+        return response["error"]
+
+
+def main(argv=None):
+
+    """
+
+    Map each directory named on the command line, writing one json document per line to stdout.
+
+    Parameters: argv (list): Arguments, not including the program name. Defaults to sys.argv[1:].
+
+    Returns: (int): 0 if every directory mapped, otherwise 1.
+
+    """
+
+    parser = argparse.ArgumentParser(
+        prog="meta-mapper-client", description="Map directories using a running mapping service.")
+    parser.add_argument("archive_dirs", nargs='+', metavar="DIR",
+                        help="Directories to map. Use '-' to read them from stdin, one per line.")
+    parser.add_argument("--socket", required=True, help="Path of the service's socket.")
+    parser.add_argument("--fields", metavar="KEY,...",
+                        help="Compute only these template keys, e.g. archived_size.")
+    args = parser.parse_args(argv)
+    fields = args.fields.split(',') if args.fields else None
+
+    exit_code = 0
+    with MappingClient(args.socket) as client:
+        for archive_dir in args.archive_dirs:
+            archive_dirs = (line.strip() for line in sys.stdin) if archive_dir == '-' else [archive_dir]
+            for curr_dir in archive_dirs:
+                if not curr_dir:
+                    continue
+                result = client.create_new_document(curr_dir, fields=fields)
+                if isinstance(result, str):
+                    sys.stderr.write(f"{curr_dir}: {result}\n")
+                    exit_code = 1
+                else:
+                    sys.stdout.write(json.dumps(result) + '\n')
+
+    return exit_code
+
+
+if __name__ == "__main__":
+    sys.exit(main())
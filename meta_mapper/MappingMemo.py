@@ -0,0 +1,111 @@
+"""
+    Remember the path-independent part of mapping, so that directories carrying identical
+    metadata docs don't repeat field mapping, date conversion and group lookups.
+"""
+
+from collections import OrderedDict
+import hashlib
+import json
+import threading
+
+
+def get_doc_digest(doc):
+
+    """
+
+    Get a digest of a normalized metadata doc.
+
+    Key order is kept, not sorted: group lookups scan a doc in order, so two docs that differ
+    only in key order can map differently.
+
+    Parameters: doc (dict): A metadata doc, loaded and normalized.
+
+    Returns: (bytes): Digest that is equal for docs with equal contents.
+
+    """
+
+    doc_json = json.dumps(doc, separators=(',', ':'))
+    return hashlib.blake2b(doc_json.encode("utf-8"), digest_size=16).digest()
+
+
+class MappingMemo:
+
+    """
+    A bounded, thread-safe, least-recently-used memo of mapping results.
+
+    Results are kept as they're given, not copied. Callers must copy whatever they'll change,
+    so that what is remembered stays as it was.
+    """
+
+    def __init__(self, max_entries=1000):
+
+        """
+
+        Parameters: max_entries (int): Number of results to remember.
+
+        """
+
+        self.max_entries = max(1, max_entries)
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.num_hits = 0
+        self.num_misses = 0
+
+
+    def get(self, key):
+
+        """
+
+        Look up a result.
+
+        Parameters: key (hashable): The key the result was remembered under.
+
+        Returns: The result, or None if it isn't remembered.
+
+        """
+
+        with self.lock:
+            result = self.entries.get(key)
+            if result is None:
+                self.num_misses += 1
+                return None
+            self.entries.move_to_end(key)
+            self.num_hits += 1
+        return result
+
+
+    def put(self, key, result):
+
+        """
+
+        Remember a result, forgetting the least recently used one if the memo is full.
+
+        Parameters:
+            key (hashable): The key to remember the result under.
+            result: The result. Must not be None.
+
+        Returns: None
+
+        """
+
+        with self.lock:
+            self.entries[key] = result
+            self.entries.move_to_end(key)
+            if len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+
+    def get_stats(self):
+
+        """
+
+        Get the number of lookups that found a result, and that didn't.
+
+        Parameters: None
+
+        Returns: (dict): {"hits": int, "misses": int, "entries": int}
+
+        """
+
+        with self.lock:
+            return {"hits": self.num_hits, "misses": self.num_misses, "entries": len(self.entries)}
@@ -0,0 +1,310 @@
+"""
+    A long-lived mapping service on a Unix-domain socket, for callers that map one directory at a
+    time (e.g. archiving scripts) and shouldn't pay for Python startup, config parsing and
+    SystemGroupsFinder construction on every call.
+
+    The service pre-forks a pool of worker processes. Each builds one mapper when it starts and
+    keeps it warm, then takes connections from the shared listening socket. The protocol is one
+    json request per line, answered by one json response per line:
+
+        {"path": "/archive/GT/2020/x"}          -> {"ok": true, "doc": {...}}
+        {"path": "...", "fields": ["archived_size"]} -> {"ok": true, "doc": {"archived_size": ...}}
+        {"doc": {"archived_path": ...}}         -> {"ok": true, "doc": {...}}
+        (anything that fails to map)            -> {"ok": false, "error": "ERROR: ..."}
+
+    See MappingClient for a thin client.
+"""
+
+import json
+import os
+import signal
+import socket
+import stat
+import sys
+import time
+import traceback
+
+from meta_mapper.IoScheduler import SharedMountLimits
+from meta_mapper.MetaMapper import MetaMapper, get_config
+
+
+def handle_request(mapper, request):
+
+    """
+
+    Map the directory or document in one request.
+
+    Parameters:
+        mapper (MetaMapper): The mapper to use.
+        request (dict): {"path": archive_dir} or {"doc": old_doc}. A path request may also
+            have "fields", a list of the template keys to compute.
+
+    Returns: (dict): {"ok": True, "doc": new_doc} or {"ok": False, "error": error string}.
+
+    """
+
+    try:
+        if "path" in request:
+            result = mapper.create_new_document(request["path"], fields=request.get("fields"))
+        elif "doc" in request:
+            result = mapper.create_new_document_from_given_doc(request["doc"])
+        else:
+            result = "ERROR: request needs a path or a doc"
+    except Exception as e:
+        # Report the exception rather than losing the worker to one bad request.
+        result = f"ERROR: {type(e).__name__}: {e}"
+
+    if isinstance(result, str):
+        return {"ok": False, "error": result}
+    return {"ok": True, "doc": result}
+
+
+class MappingService:
+
+    """
+    A pre-forked pool of warm mappers serving requests on a Unix-domain socket.
+    """
+
+    def __init__(self, socket_path, workers=4, mapper_kwargs=None, idle_timeout=60.0):
+
+        """
+
+        Parameters:
+            socket_path (str): Path of the Unix-domain socket to listen on.
+            workers (int): Number of worker processes.
+            mapper_kwargs (dict): Keyword arguments for each worker's MetaMapper.
+            idle_timeout (float): Seconds a connection may sit idle before a worker drops it,
+                so an idle client can't tie up a worker for good.
+
+        """
+
+        self.socket_path = socket_path
+        self.workers = max(1, workers)
+        self.mapper_kwargs = mapper_kwargs or {}
+        self.idle_timeout = idle_timeout
+
+        self.listener = None
+        self.children = set()
+        self.stopping = False
+
+
+    def serve_forever(self):
+
+        """
+
+        Listen on the socket and keep the worker pool running until SIGTERM or SIGINT. Workers
+        that die are replaced.
+
+        Parameters: None
+
+        Returns: None. Raises RuntimeError if something other than a stale socket is in the
+            way of the socket path.
+
+        """
+
+        # A socket file left behind by a previous run would make bind() fail.
+        self.__remove_stale_socket()
+
+        self.listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.listener.bind(self.socket_path)
+        self.listener.listen(128)
+        socket_inode = os.stat(self.socket_path).st_ino
+
+        # Workers are separate processes, each with its own I/O scheduler. Share per-mount
+        # caps between them, so the pool as a whole keeps to each mount's limit. Slots held by
+        # a worker that dies are freed with it, so its replacement can use the same limits.
+        self.mapper_kwargs = dict(self.mapper_kwargs)
+        self.mapper_kwargs.setdefault("shared_io_limits", SharedMountLimits(get_config()))
+
+        signal.signal(signal.SIGTERM, self.__stop)
+
+        try:
+            for _ in range(self.workers):
+                self.__spawn_worker()
+
+            while self.children:
+                try:
+                    pid, _ = os.wait()
+                except ChildProcessError:
+                    break
+                self.children.discard(pid)
+                if not self.stopping:
+                    # Pause first, so a worker that fails on startup doesn't make us spin.
+                    sys.stderr.write(f"meta-mapper serve: worker {pid} exited; starting a new one\n")
+                    time.sleep(1)
+                    self.__spawn_worker()
+        finally:
+            self.stopping = True
+            self.__kill_children()
+            self.listener.close()
+
+            # Only remove the socket if it's still ours.
+            try:
+                if os.stat(self.socket_path).st_ino == socket_inode:
+                    os.unlink(self.socket_path)
+            except FileNotFoundError:
+                pass
+
+
+
+    """
+
+    PRIVATE METHODS
+
+    """
+
+    def __handle_connection(self, mapper, conn):
+
+        """
+
+        Answer every request on one connection, until the client closes it or goes idle.
+
+        Parameters:
+            mapper (MetaMapper): This worker's mapper.
+            conn (socket): The client connection.
+
+        Returns: None
+
+        """
+
+        conn.settimeout(self.idle_timeout)
+        with conn.makefile("rb") as reader, conn.makefile("wb") as writer:
+            try:
+                for line in reader:
+                    if not line.strip():
+                        continue
+                    try:
+                        response = handle_request(mapper, json.loads(line))
+                    except ValueError as e:
+                        response = {"ok": False, "error": f"ERROR: bad request: {e}"}
+                    writer.write(json.dumps(response).encode("utf-8") + b'\n')
+                    writer.flush()
+            except (socket.timeout, ConnectionError):
+                # The client went idle or away. Drop the connection.
+                pass
+
+
+    def __kill_children(self):
+
+        """
+
+        Terminate all the worker processes and wait for them to exit.
+
+        Parameters: None
+
+        Returns: None
+
+        """
+
+        for pid in list(self.children):
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+
+        for pid in list(self.children):
+            try:
+                os.waitpid(pid, 0)
+            except ChildProcessError:
+                pass
+            self.children.discard(pid)
+
+
+    def __remove_stale_socket(self):
+
+        """
+
+        Remove a socket left at the socket path by a service that is no longer running.
+        Anything else there is left alone.
+
+        Parameters: None
+
+        Returns: None. Raises RuntimeError if the path is not a socket, or a service is
+            listening on it.
+
+        """
+
+        try:
+            mode = os.lstat(self.socket_path).st_mode
+        except FileNotFoundError:
+            return
+
+        if not stat.S_ISSOCK(mode):
+            raise RuntimeError(f"{self.socket_path} exists and is not a socket")
+
+        probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            probe.connect(self.socket_path)
+        except (ConnectionRefusedError, FileNotFoundError):
+            # Nothing is listening, so the socket is left over from a service that died.
+            os.unlink(self.socket_path)
+            return
+        finally:
+            probe.close()
+
+        raise RuntimeError(f"A service is already listening on {self.socket_path}")
+
+
+    def __run_worker(self):
+
+        """
+
+        The body of a worker process: build a mapper, then serve connections forever.
+
+        Parameters: None
+
+        Returns: None (never returns)
+
+        """
+
+        # The parent decides when workers stop. Let signals end a worker quietly.
+        signal.signal(signal.SIGTERM, signal.SIG_DFL)
+        signal.signal(signal.SIGINT, signal.SIG_DFL)
+
+        mapper = MetaMapper(**self.mapper_kwargs)
+        while True:
+            conn, _ = self.listener.accept()
+            with conn:
+                self.__handle_connection(mapper, conn)
+
+
+    def __spawn_worker(self):
+
+        """
+
+        Fork a new worker process.
+
+        Parameters: None
+
+        Returns: None
+
+        """
+
+        pid = os.fork()
+        if pid:
+            self.children.add(pid)
+            return
+
+        # The worker must never return into the parent's code, whatever happens.
+        try:
+            self.__run_worker()
+        except BaseException:
+            traceback.print_exc()
+        finally:
+            os._exit(1)
+
+
+    def __stop(self, signum, frame):
+
+        """
+
+        Signal handler for SIGTERM: stop replacing workers, and terminate the ones running.
+
+        """
+
+        self.stopping = True
+        for pid in list(self.children):
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
@@ -0,0 +1,373 @@
+"""
+    Opt-in memory instrumentation for batch runs: peak memory per directory and per mapping
+    stage, the call sites that allocate the most, and the largest input files.
+
+    A MemoryProfiler lives in each process that maps directories, and produces one record per
+    directory. Records are small dicts, so they can be sent back from worker processes and
+    combined into a MemoryReport by the process running the batch.
+
+    tracemalloc sees the whole process, so records are only meaningful when a process maps one
+    directory at a time, i.e. not when threads share a mapper.
+"""
+
+from collections import Counter, defaultdict
+from contextlib import contextmanager
+import resource
+import tracemalloc
+
+
+class MemoryProfiler:
+
+    """
+    Measure memory while a process maps directories, one directory at a time.
+    """
+
+    def __init__(self, num_frames=5, snapshot_every=10, num_sites=10):
+
+        """
+
+        Start tracing allocations.
+
+        Parameters:
+            num_frames (int): Stack frames tracemalloc keeps for each allocation.
+            snapshot_every (int): Take allocation snapshots for every Nth directory. Snapshots
+                are the expensive part of profiling.
+            num_sites (int): Number of top allocation sites to keep per snapshotted directory.
+
+        """
+
+        self.snapshot_every = max(1, snapshot_every)
+        self.num_sites = num_sites
+        self.num_dirs = 0
+        self.record = None
+        self.baseline = None
+
+        if not tracemalloc.is_tracing():
+            tracemalloc.start(num_frames)
+
+        self.filters = [
+            tracemalloc.Filter(False, tracemalloc.__file__),
+            tracemalloc.Filter(False, "<frozen importlib._bootstrap>"),
+            tracemalloc.Filter(False, __file__),
+        ]
+
+
+    def begin_directory(self, archive_dir):
+
+        """
+
+        Start measuring a directory.
+
+        Parameters: archive_dir (str): The directory about to be mapped.
+
+        Returns: None
+
+        """
+
+        # Take the baseline snapshot first, so building it doesn't count towards the peaks.
+        self.baseline = None
+        if self.num_dirs % self.snapshot_every == 0:
+            self.baseline = tracemalloc.take_snapshot().filter_traces(self.filters)
+        self.num_dirs += 1
+
+        _reset_peak_rss()
+        _reset_peak_traced()
+
+        self.record = {
+            "archive_dir": archive_dir,
+            "start_traced": tracemalloc.get_traced_memory()[0],
+            "peak_traced": 0,
+            "peak_rss": 0,
+            "stages": {},
+            "inputs": [],
+            "sites": [],
+        }
+
+
+    @contextmanager
+    def stage(self, name):
+
+        """
+
+        Measure one stage of mapping a directory. Use as a context manager.
+
+        Parameters: name (str): Name of the stage, e.g. "read_doc".
+
+        Returns: A context manager.
+
+        """
+
+        if self.record is None:
+            # Not inside begin_directory()/end_directory(). Nothing to record against.
+            yield
+            return
+
+        self.__note_peak()
+        _reset_peak_traced()
+        start = tracemalloc.get_traced_memory()[0]
+        try:
+            yield
+        finally:
+            current, peak = tracemalloc.get_traced_memory()
+            self.record["peak_traced"] = max(self.record["peak_traced"], peak)
+
+            # A stage can run more than once per directory (e.g. once per metadata doc).
+            stage = self.record["stages"].setdefault(name, {"peak": 0, "retained": 0})
+            stage["peak"] = max(stage["peak"], peak - start)
+            stage["retained"] += current - start
+
+
+    def note_input(self, filepath, num_bytes):
+
+        """
+
+        Record an input file read while mapping the directory.
+
+        Parameters:
+            filepath (str): The file.
+            num_bytes (int): Its size.
+
+        Returns: None
+
+        """
+
+        if self.record is not None:
+            self.record["inputs"].append((filepath, num_bytes))
+
+
+    def end_directory(self):
+
+        """
+
+        Finish measuring a directory. Call this while the mapped document is still referenced,
+        so its allocations show up in the snapshot.
+
+        Parameters: None
+
+        Returns: (dict): The directory's memory record.
+
+        """
+
+        record = self.record
+        self.record = None
+        if record is None:
+            return None
+
+        current, peak = tracemalloc.get_traced_memory()
+        record["peak_traced"] = max(record["peak_traced"], peak) - record["start_traced"]
+        record["retained"] = current - record.pop("start_traced")
+        record["peak_rss"] = _get_peak_rss()
+
+        if self.baseline is not None:
+            snapshot = tracemalloc.take_snapshot().filter_traces(self.filters)
+            diffs = snapshot.compare_to(self.baseline, "lineno")
+            record["sites"] = [
+                (f"{diff.traceback[0].filename}:{diff.traceback[0].lineno}", diff.size_diff)
+                for diff in diffs[:self.num_sites] if diff.size_diff > 0
+            ]
+            self.baseline = None
+
+        return record
+
+
+
+    """
+
+    PRIVATE METHODS
+
+    """
+
+    def __note_peak(self):
+
+        """
+
+        Fold the peak since the last reset into the directory's peak, before resetting it again.
+
+        Parameters: None
+
+        Returns: None
+
+        """
+
+        self.record["peak_traced"] = max(self.record["peak_traced"], tracemalloc.get_traced_memory()[1])
+
+
+class MemoryReport:
+
+    """
+    Combine memory records from all directories of a batch into a ranked report.
+    """
+
+    def __init__(self, num_top=20):
+
+        """
+
+        Parameters: num_top (int): Number of entries to list in each section of the report.
+
+        """
+
+        self.num_top = num_top
+        self.num_dirs = 0
+        self.dirs_by_rss = []
+
+        # For each stage: [max peak, sum of peaks, number of directories, total retained]
+        self.stage_stats = defaultdict(lambda: [0, 0, 0, 0])
+        self.site_bytes = Counter()
+        self.site_dirs = Counter()
+        self.inputs = []
+        self.max_rss = 0
+
+
+    def add(self, record):
+
+        """
+
+        Add one directory's record.
+
+        Parameters: record (dict): From MemoryProfiler.end_directory().
+
+        Returns: None
+
+        """
+
+        self.num_dirs += 1
+        self.max_rss = max(self.max_rss, record["peak_rss"])
+        self.dirs_by_rss.append((record["peak_rss"], record["peak_traced"], record["archive_dir"]))
+
+        for name, stage in record["stages"].items():
+            stats = self.stage_stats[name]
+            stats[0] = max(stats[0], stage["peak"])
+            stats[1] += stage["peak"]
+            stats[2] += 1
+            stats[3] += stage["retained"]
+
+        for site, num_bytes in record["sites"]:
+            self.site_bytes[site] += num_bytes
+            self.site_dirs[site] += 1
+
+        for filepath, num_bytes in record["inputs"]:
+            self.inputs.append((num_bytes, filepath))
+
+        # Keep the lists bounded on very large runs.
+        if len(self.dirs_by_rss) > self.num_top * 50:
+            self.dirs_by_rss = sorted(self.dirs_by_rss, reverse=True)[:self.num_top]
+        if len(self.inputs) > self.num_top * 50:
+            self.inputs = sorted(self.inputs, reverse=True)[:self.num_top]
+
+
+    def write(self, out):
+
+        """
+
+        Write the report as text.
+
+        Parameters: out (file): Where to write it.
+
+        Returns: None
+
+        """
+
+        lines = [f"Memory profile of {self.num_dirs} directories",
+                 f"Highest peak RSS: {_format_bytes(self.max_rss)}", ""]
+
+        lines.append("Directories by peak RSS (peak RSS, peak traced by python):")
+        for peak_rss, peak_traced, archive_dir in sorted(self.dirs_by_rss, reverse=True)[:self.num_top]:
+            lines.append(f"  {_format_bytes(peak_rss):>10}  {_format_bytes(peak_traced):>10}  {archive_dir}")
+        lines.append("")
+
+        lines.append("Stages (max peak, mean peak, total retained):")
+        by_max_peak = sorted(self.stage_stats.items(), key=lambda item: item[1][0], reverse=True)
+        for name, (max_peak, sum_peaks, num_dirs, retained) in by_max_peak:
+            lines.append(f"  {_format_bytes(max_peak):>10}  {_format_bytes(sum_peaks / num_dirs):>10}  "
+                         f"{_format_bytes(retained):>10}  {name}")
+        lines.append("")
+
+        lines.append("Allocation sites, over sampled directories (bytes retained, directories):")
+        for site, num_bytes in self.site_bytes.most_common(self.num_top):
+            lines.append(f"  {_format_bytes(num_bytes):>10}  {self.site_dirs[site]:>8}  {site}")
+        lines.append("")
+
+        lines.append("Largest input files:")
+        for num_bytes, filepath in sorted(self.inputs, reverse=True)[:self.num_top]:
+            lines.append(f"  {_format_bytes(num_bytes):>10}  {filepath}")
+
+        out.write('\n'.join(lines) + '\n')
+
+
+def _format_bytes(num_bytes):
+
+    """
+
+    Format a number of bytes for people, e.g. 1.5 MiB.
+
+    Parameters: num_bytes (float): The number of bytes.
+
+    Returns: (str): The formatted size.
+
+    """
+
+    for unit in ("B", "KiB", "MiB", "GiB"):
+        if abs(num_bytes) < 1024:
+            return f"{num_bytes:.1f} {unit}"
+        num_bytes /= 1024
+    return f"{num_bytes:.1f} TiB"
+
+
+def _get_peak_rss():
+
+    """
+
+    Get this process's peak resident set size since the last _reset_peak_rss().
+
+    On Linux this reads VmHWM, which can be reset. Elsewhere it falls back to the peak over
+    the life of the process.
+
+    Parameters: None
+
+    Returns: (int): Peak RSS in bytes.
+
+    """
+
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def _reset_peak_rss():
+
+    """
+
+    Reset the peak RSS, where the OS allows it.
+
+    Parameters: None
+
+    Returns: None
+
+    """
+
+    try:
+        with open("/proc/self/clear_refs", "w") as f:
+            f.write("5")
+    except OSError:
+        pass
+
+
+def _reset_peak_traced():
+
+    """
+
+    Reset tracemalloc's peak. Not available before python 3.9, where the peak is left alone.
+
+    Parameters: None
+
+    Returns: None
+
+    """
+
+    if hasattr(tracemalloc, "reset_peak"):
+        tracemalloc.reset_peak()
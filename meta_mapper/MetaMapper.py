@@ -4,6 +4,7 @@
 """
 
 import configparser
+from contextlib import nullcontext
 from datetime import datetime
 import dateutil.parser as date_parser
 import json
@@ -11,37 +12,122 @@ import os
 from pathlib import Path
 import re
 import subprocess
+import sys
 
 from system_groups_finder import SystemGroupsFinder
 
+from meta_mapper.GroupSnapshot import SnapshotGroupsFinder
+from meta_mapper.IoScheduler import IoScheduler
+from meta_mapper.LazyDocument import LazyDocument
+from meta_mapper.MappingMemo import MappingMemo, get_doc_digest
+
+
+def get_config():
+
+    """
+
+    Load the config file that resides in the same directory as this script.
+
+    Parameters: None
+
+    Returns: (ConfigParser): The parsed meta_mapper config.
+
+    """
+
+    # Get the source directory where this script resides. Look for a config file in it.
+    root_dir = os.path.dirname(os.path.realpath(__file__))
+    config_filename = str(Path(root_dir, "meta_mapper_config.cfg"))
+    assert os.path.isfile(config_filename)
+
+    config = configparser.ConfigParser()
+    config.read(config_filename)
+    return config
+
+
+def get_template_keys(config):
+
+    """
+
+    Get all the keys in the new format, discarding the values in the template's example file.
+
+    Parameters: config (ConfigParser): The meta_mapper config.
+
+    Returns: (list): The template's keys, in order.
+
+    """
+
+    # The template MUST be located in the same directory as the config file.
+    root_dir = os.path.dirname(os.path.realpath(__file__))
+    template_filename = str(Path(root_dir, config["format"]["template"]))
+    assert os.path.isfile(template_filename)
+    with open (template_filename) as f:
+        return list(json.load(f).keys())
+
+
+class MappingContext:
+
+    """
+    Per-call state used while building one new document. Keeping it out of the mapper means
+    one mapper instance can be shared by several threads.
+    """
+
+    def __init__(self):
+
+        # Sub-dictionaries of the current doc, loaded with snake_case keys. These are used in
+        # the __get_curr_doc_val method, and are cleared for each new doc.
+        self.sub_dicts = {}
+
+        # Track whether we found a useable metadata document
+        self.useable_doc_found = False
+
+        # Whether the archive dir is a valid directory. Checked once, on first use.
+        self.archive_dir_exists = None
+
+        # Values for template keys that weren't asked for, kept without their date parsing or
+        # lookups in case they have to be compared with another value for the same key.
+        self.unconverted_vals = {}
+
+        # Whether a group lookup for this document missed the group snapshot, if one is used.
+        self.snapshot_missed = False
+
+
 class MetaMapper:
 
     """
     Given a metadata file in an old format, and an archived.json file,
     populate a document in a new format.
+
+    After __init__, a mapper holds no per-document state, so one instance may be shared by
+    the threads of a pool. All state for a single call lives in a MappingContext.
     """
 
-    def __init__(self):
+    def __init__(self, io_scheduler=None, system_groups_finder=None, group_snapshot=None,
+                 memory_profiler=None, memo_size=None, shared_io_limits=None):
 
         """
 
         Load the new template, field mapping, and formatting instructions from the config file.
 
-        """
+        Parameters:
+            io_scheduler (IoScheduler): Scheduler for filesystem work. Pass one in to share it
+                between mappers; by default each mapper builds its own from the config.
+            system_groups_finder: Finder to use for group, user and lab lookups instead of
+                a new SystemGroupsFinder.
+            group_snapshot (str): Snapshot file to answer group, user and lab lookups from,
+                instead of the live SystemGroupsFinder.
+            memory_profiler (MemoryProfiler): Profiler to measure each stage of mapping with.
+                Profiling is off when this is None.
+            memo_size (int): Number of mapped sets of docs to remember, so directories with
+                identical docs share the work. 0 turns the memo off. Defaults to the config.
+            shared_io_limits (SharedMountLimits): Per-mount limits shared with the other
+                processes of a pool. Ignored if an io_scheduler is given.
 
-        # Get the source directory where this script resides. Look for a config file in it.
-        root_dir = os.path.dirname(os.path.realpath(__file__))
-        config_filename = str(Path(root_dir, "meta_mapper_config.cfg"))
-        assert os.path.isfile(config_filename)
+        """
 
-        self.config = configparser.ConfigParser()
-        self.config.read(config_filename)
+        self.config = get_config()
 
         # Get all the keys in the new format, discarding the values in the template's example file.
-        template_filename = str(Path(root_dir, self.config["format"]["template"]))
-        assert os.path.isfile(template_filename)
-        with open (template_filename) as f:
-            self.template = dict.fromkeys(json.load(f).keys(), None)
+        self.template = dict.fromkeys(get_template_keys(self.config), None)
         self.user_metadata_key = self.config["format"]["user_metadata_key"]        
         self.defaults_tag = self.config["format"]["defaults_tag"]
 
@@ -54,8 +140,27 @@ class MetaMapper:
         self.date_key_pattern = self.config["dates"]["date_key_pattern"]
         self.date_format = self.config["dates"]["date_format"]
  
-        # Get an instance of the SystemGroupsFinder
-        self.system_groups_finder = SystemGroupsFinder.SystemGroupsFinder()
+        # Memory profiling is opt-in. When it's off, stages are wrapped in a do-nothing context.
+        self.memory_profiler = memory_profiler
+
+        # Results of mapping identical docs are shared between directories.
+        if memo_size is None:
+            memo_size = self.config["memo"].getint("max_entries")
+        self.memo = MappingMemo(memo_size) if memo_size > 0 else None
+
+        # All filesystem work goes through the I/O scheduler, which limits concurrency per mount.
+        self.io_scheduler = io_scheduler or IoScheduler(self.config, shared_limits=shared_io_limits)
+
+        # Get an instance of the SystemGroupsFinder, unless the lookups are to be answered by
+        # something else. A snapshot's version is recorded in every new doc.
+        if system_groups_finder:
+            self.system_groups_finder = system_groups_finder
+        elif group_snapshot:
+            self.system_groups_finder = SnapshotGroupsFinder(group_snapshot)
+        else:
+            self.system_groups_finder = SystemGroupsFinder.SystemGroupsFinder()
+        self.group_snapshot_version = getattr(self.system_groups_finder, "snapshot_version", None)
+        self.group_snapshot_version_key = self.config["format"]["group_snapshot_version_key"]
         self.system_groups_key = self.config["format"]["system_groups_key"]
 
         # Save the name of the user_id and manager_user_id key
@@ -63,6 +168,9 @@ class MetaMapper:
         self.user_id_key = self.config["format"]["user_id_key"]
         self.sgf_manager_userid = self.config["format"]["sgf_manager_user_id_key"]
 
+        # The fields filled in by group lookups. A snapshot's version vouches for all of them.
+        self.lookup_fields = frozenset([self.system_groups_key, self.manager_user_id_key, self.user_id_key])
+
         # Save the name of the date key
         self.date_key = self.config["format"]["date_key"]        
 
@@ -95,7 +203,7 @@ class MetaMapper:
         self.vals_to_replace = [x.strip() for x in self.config["replace_vals"]["vals_to_replace"].split(',')]
 
 
-    def create_new_document(self, archive_dir):
+    def create_new_document(self, archive_dir, fields=None):
 
         """
 
@@ -104,92 +212,70 @@ class MetaMapper:
         The document will contain keys in the template, with values populated by searching 
         the jsons in the given directory.
 
-        Parameters: archive_dir (str): Absolute path to a directory in the archive.
+        Parameters:
+            archive_dir (str): Absolute path to a directory in the archive.
+            fields (list): Template keys to compute, e.g. ["archived_size"]. Only the work those
+                keys need is done (no du walk unless archived_size is asked for, no group
+                lookups unless system_groups or a user id is), and the new document has only
+                those keys. Defaults to every key.
 
         Returns:
             new_doc (dict): New metadata document, OR error string starting with "ERROR"
 
         """
 
-        # Copy the template into the new doc that will be returned after it's populated. 
-        new_doc = self.get_blank_template()
+        fields = self.__check_fields(fields)
+        context = MappingContext()
+        docs = self.__read_docs(context, archive_dir)
+        if isinstance(docs, str):
+            return docs
 
-        # Find which kind of metadata to expect from the directory path.
-        category_tag = self.__get_category_tag(archive_dir)
-        if not category_tag:
-            # This kind of metadata is not yet handled.
-            return "ERROR: could not determine metadata category"
+        return self.__build_doc(context, archive_dir, docs, fields)
 
 
-        # Track whether we found a useable metadata document
-        self.useable_doc_found = False
+    def lazy_document(self, archive_dir):
 
-        # Seek and read any metadata docs in the directory named in the config file.
-        for doc_tag, doc_filename in self.config["doc_names"].items():
-            
-            # If the directory name is part of the metadata filename, expand it.
-            doc_filename = self.__expand_dirname_for_filename(doc_filename, archive_dir)
-
-            # Load json doc with keys converted to snake_case.
-            curr_doc = self.__get_curr_doc(archive_dir, doc_filename)
-
-            if not curr_doc:
-                # doc not found in this directory
-                continue
-
-            # Immediately remove unwanted keys
-            self.__prune_keys(curr_doc)
+        """
 
-            # Strip any dollar signs ('$') from the keys.
-            curr_doc = self.__strip_dollar_signs_from_keys(curr_doc)
+        Read the metadata docs in an archive directory, and return a document whose fields are
+        each computed the first time they're read. Reading only system_groups, for example,
+        never walks the directory for its size.
 
-            # Get the section of the config file to seek by combining the category and doc tags.
-            section_tag = category_tag + '_' + doc_tag
-            if section_tag not in self.config:
-                # This kind of metadata doc is not yet handled for this category
-                continue
+        Parameters: archive_dir (str): Absolute path to a directory in the archive.
 
-            # We have found a useable doc
-            self.useable_doc_found = True
+        Returns:
+            lazy_doc (LazyDocument): The new metadata document, OR error string starting with "ERROR"
 
-            # Add vals from curr doc to new doc
-            try:
-                self.__add_vals_from_curr_doc(new_doc, section_tag, curr_doc)
-            except ValueError as e:
-                print(f"Key error for {archive_dir}:new_doc {str(e)}")
-             
-            # Tuck curr doc into user_data field, if specified in the config file.
-            self.__add_user_metadata(new_doc, section_tag, curr_doc)
+        """
 
-            # Add the system groups
-            self.__add_groups_from_doc(new_doc, curr_doc)
+        context = MappingContext()
+        docs = self.__read_docs(context, archive_dir)
+        if isinstance(docs, str):
+            return docs
 
-        # Do nothing if the archive dir had no useable metadata document
-        if not self.useable_doc_found:
-            return "ERROR: No useable metata doc found"
+        # The snapshot version is left out of docs with lookups the snapshot couldn't answer.
+        optional_fields = [self.group_snapshot_version_key] if self.group_snapshot_version else []
+        return LazyDocument(self.get_field_names(),
+                            lambda fields: self.__build_doc(context, archive_dir, docs, frozenset(fields)),
+                            optional_fields)
 
-        # Add archive_path if needed
-        self.__add_archive_path(new_doc, archive_dir)
 
-        # Add the archived size
-        self.__add_archived_size(new_doc, archive_dir)
+    def get_field_names(self):
 
-        # Add the archival status
-        self.__add_archival_status(new_doc, archive_dir)
+        """
 
-        # Add date if needed
-        self.__add_date(new_doc, archive_dir)
+        Get the names of all fields in a new document.
 
-        # Add system groups if needed
-        self.__add_groups_from_path(new_doc, archive_dir)
+        Parameters: None
 
-        # Make any needed correcttions/adjustments to the source path
-        self.__adjust_source_path(new_doc)
+        Returns: (list): The template keys, plus the group snapshot version key if a snapshot is used.
 
-        # Add any known constants
-        self.__add_default_vals(new_doc)
+        """
 
-        return new_doc
+        field_names = list(self.template)
+        if self.group_snapshot_version:
+            field_names.append(self.group_snapshot_version_key)
+        return field_names
 
 
     def create_new_document_from_given_doc(self, old_doc):
@@ -208,19 +294,19 @@ class MetaMapper:
 
         """
 
+        snapshot_misses = self.__get_snapshot_misses()
+
         # Convert all top level keys in old doc to snake_case.
         old_doc = { self.__to_snake_case(k): v for k, v in old_doc.items() }
 
 
         # Strip any dollar signs ('$') from the keys in the old doc.
-        old_doc = self.__strip_dollar_signs_from_keys(old_doc)
-
-        # Clear any saved sub-dictionaries from previous documents. These are used in the
-        # __get_curr_doc_val method.
-        self.sub_dicts = {}
+        with self.__stage("normalize_doc"):
+            old_doc = self.__strip_dollar_signs_from_keys(old_doc)
 
         # Copy the template into the new doc that will be returned after it's populated.
         new_doc = self.get_blank_template()
+        context = MappingContext()
 
         # Get the archived path
         try:
@@ -248,9 +334,9 @@ class MetaMapper:
 
             # Add vals from curr doc to new doc
             try:
-                self.__add_vals_from_curr_doc(new_doc, section_tag, old_doc)
+                self.__add_vals_from_curr_doc(context, new_doc, section_tag, old_doc, None)
             except ValueError as e:
-                print(f"Key error for {archive_dir}:new_doc {str(e)}")
+                print(f"Key error for {archive_dir}:new_doc {str(e)}", file=sys.stderr)
 
             # Tuck old doc into user_data field, if specified in the config file and not 
             # already added.
@@ -260,20 +346,26 @@ class MetaMapper:
         # TBD: elim most of these
 
         # Add the archived size
-        self.__add_archived_size(new_doc, archive_dir)
+        with self.__stage("archived_size"):
+            self.__add_archived_size(context, new_doc, archive_dir)
 
         # Add the archival status
-        self.__add_archival_status(new_doc, archive_dir, from_doc=true)
+        self.__add_archival_status(context, new_doc, archive_dir, from_doc=True)
 
         # Add date if needed
-        self.__add_date(new_doc, archive_dir)
+        self.__add_date(context, new_doc, archive_dir)
 
         # Add the system groups if needed
-        self.__add_groups_from_doc(new_doc, old_doc)
+        with self.__stage("groups_from_doc"):
+            self.__add_groups_from_doc(context, new_doc, old_doc)
 
         # Add any known constants
         self.__add_default_vals(new_doc)
 
+        # Record which group snapshot was used, if any, unless it couldn't answer every lookup
+        context.snapshot_missed = self.__get_snapshot_misses() != snapshot_misses
+        self.__add_group_snapshot_version(context, new_doc)
+
         return new_doc
 
 
@@ -299,13 +391,14 @@ class MetaMapper:
 
     """
 
-    def __add_archive_path(self, new_doc, archive_dir):
+    def __add_archive_path(self, context, new_doc, archive_dir):
 
         """
 
         Add a given archive directory to the doc if it doesn't already have an archive_path
         
         Parameters:
+            context (MappingContext): State for the document being built.
             new_doc (dict): The new dictionary being populated.
             archive_dir (str): A directory in the archive
 
@@ -318,21 +411,20 @@ class MetaMapper:
             return
 
         # If the directory doesn't start with the archive root or isn't a valid directory, do nothing.
-        if not archive_dir.startswith(self.archive_root) or not os.path.isdir(archive_dir):
+        if not archive_dir.startswith(self.archive_root) or not self.__is_dir(context, archive_dir):
             return
-        # Clear any saved sub-dictionaries from previous documents
-        self.sub_dicts = {}
 
         new_doc[self.archive_path_key] = archive_dir
 
 
-    def __add_archived_size(self, new_doc, archive_dir):
+    def __add_archived_size(self, context, new_doc, archive_dir):
 
         """
 
         Add the given archive directory's disk usage size in bytes to the doc.
 
         Parameters:
+            context (MappingContext): State for the document being built.
             new_doc (dict): The new dictionary being populated.
             archive_dir (str): A directory in the archive
 
@@ -341,22 +433,24 @@ class MetaMapper:
         """
 
         # If the directory doesn't start with the archive root or isn't a valid directory, do nothing.
-        if not archive_dir.startswith(self.archive_root) or not os.path.isdir(archive_dir):
+        if not archive_dir.startswith(self.archive_root) or not self.__is_dir(context, archive_dir):
             return
 
-        archived_size= int(subprocess.check_output(
+        # du walks the whole tree, so it goes through the mount's separate limit for walks.
+        archived_size= int(self.io_scheduler.run_walk(archive_dir, subprocess.check_output,
             ["du", "-sb", archive_dir]).split()[0].decode("utf-8"))
 
         new_doc[self.archived_size_key] = archived_size
 
 
-    def __add_archival_status(self, new_doc, archive_dir, from_doc=False):
+    def __add_archival_status(self, context, new_doc, archive_dir, from_doc=False):
 
         """
 
         Mark the archival_status completed if this directory is already in the archive and has metadata.
 
         Parameters:
+            context (MappingContext): State for the document being built.
             new_doc (dict): The new dictionary being populated.
             archive_dir (str): A directory in the archive
 
@@ -365,23 +459,24 @@ class MetaMapper:
         """
 
         # If the directory doesn't start with the archive root or isn't a valid directory, do nothing.
-        if not archive_dir.startswith(self.archive_root) or not os.path.isdir(archive_dir):
+        if not archive_dir.startswith(self.archive_root) or not self.__is_dir(context, archive_dir):
             return
 
         # If it doesn't have metadata, and we're adding status to an existing doc, do nothing.
-        if not self.useable_doc_found and not from_doc:
+        if not context.useable_doc_found and not from_doc:
             return
 
         new_doc[self.archival_status_key] = self.archival_status_done_msg
 
 
-    def __add_date(self, new_doc, archive_dir):
+    def __add_date(self, context, new_doc, archive_dir):
 
         """
 
         If the doc doesn't have a date, use the last modified date of the given archive dir.
 
         Parameters:
+            context (MappingContext): State for the document being built.
             new_doc (dict): The new dictionary being populated.
             archive_dir (str): A directory in the archive
 
@@ -394,17 +489,18 @@ class MetaMapper:
             return        
 
         # If the directory isn't a valid directory, do nothing.
-        if not os.path.isdir(archive_dir):
+        if not self.__is_dir(context, archive_dir):
             return
 
         # Get the directory's lat modified, convert to datetime as a string
-        mod_date = str(datetime.fromtimestamp(os.path.getmtime(archive_dir)))
+        mod_date = str(datetime.fromtimestamp(
+            self.io_scheduler.run(archive_dir, os.path.getmtime, archive_dir)))
 
         # Convert the date to the desired format and assign it to the new_doc's date key
         new_doc[self.date_key] = self.__get_converted_date(mod_date)
         
 
-    def __add_default_vals(self, new_doc):
+    def __add_default_vals(self, new_doc, fields=None):
 
         """
 
@@ -420,6 +516,7 @@ class MetaMapper:
 
         Parameters:
             new_doc (dict): The new dictionary being populated.
+            fields (frozenset): Template keys to fill in, or None for all of them.
 
         Returns: None
 
@@ -427,8 +524,8 @@ class MetaMapper:
 
         for curr_key, packed_val in self.config[self.defaults_tag].items():
 
-            # Skip any key not in the template
-            if curr_key not in new_doc:
+            # Skip any key not in the template, or not asked for
+            if curr_key not in new_doc or not self.__wants(fields, curr_key):
                 continue
 
             # Get the default value and type that we want.
@@ -485,13 +582,14 @@ class MetaMapper:
 
 
 
-    def __add_groups_from_doc(self, new_doc, curr_doc):
+    def __add_groups_from_doc(self, context, new_doc, curr_doc):
 
         """
 
         Try to determine system_groups from the current document.
 
         Parameters:
+            context (MappingContext): State for the document being built.
             new_doc (dict): The new dictionary being populated.
             curr_doc (dic)): 
 
@@ -511,8 +609,8 @@ class MetaMapper:
         groups = self.system_groups_finder.get_groups_from_entire_doc(curr_doc)
 
         # If we found None, check any sub-dicts we may have saved.
-        if not groups and self.sub_dicts:
-            for key, sub_dict in self.sub_dicts.items():
+        if not groups and context.sub_dicts:
+            for key, sub_dict in context.sub_dicts.items():
                 groups = self.system_groups_finder.get_groups_from_entire_doc(sub_dict)
                 if groups:
                     break 
@@ -521,12 +619,33 @@ class MetaMapper:
         new_doc[self.system_groups_key] = groups
 
 
-    def __add_groups_from_path(self, new_doc, archive_dir):
+    def __add_group_snapshot_version(self, context, new_doc):
+
+        """
+
+        If group lookups were answered from a snapshot, record the snapshot's version in the doc.
+        A doc with lookups the snapshot couldn't answer doesn't get the version: its groups or
+        user ids may be missing, and it shouldn't look like the snapshot vouches for them.
+
+        Parameters:
+            context (MappingContext): State for the document being built.
+            new_doc (dict): The new dictionary being populated.
+
+        Returns: None
+
+        """
+
+        if self.group_snapshot_version and not context.snapshot_missed:
+            new_doc[self.group_snapshot_version_key] = self.group_snapshot_version
+
+
+    def __add_groups_from_path(self, context, new_doc, archive_dir):
 
         """
 
         If the doc doesn't have a val for system_groups, try to find one from the archive path
         Parameters:
+            context (MappingContext): State for the document being built.
             new_doc (dict): The new dictionary being populated.
             archive_dir (str): A directory in the archive
 
@@ -539,7 +658,7 @@ class MetaMapper:
             return
 
         # If the directory isn't a valid directory, do nothing.
-        if not os.path.isdir(archive_dir):
+        if not self.__is_dir(context, archive_dir):
             return
 
         new_doc[self.system_groups_key] = self.system_groups_finder.search_archived_path_for_group_name(archive_dir, "system_groups")
@@ -569,16 +688,18 @@ class MetaMapper:
             pass
 
 
-    def __add_vals_from_curr_doc(self, new_doc, section_tag, curr_doc):
+    def __add_vals_from_curr_doc(self, context, new_doc, section_tag, curr_doc, fields):
 
         """ALL_CT_ARCHIVE
         Add values to the new doc from fields in the current doc specified in the config file.
 
         Parameters:
+            context: (MappingContext): State for the document being built.
             new_doc: (dict):     The new document being created.
             category_tag: (str): The category of metadata this document matches.
             doc_tag: (str):      The section tag in the config file for this document.
             curr_doc: (dict):    The current document loaded from a json file.
+            fields: (frozenset): Template keys to fill in, or None for all of them.
 
         Returns: new_doc as dict, with vals added, if any.
 
@@ -586,6 +707,7 @@ class MetaMapper:
 
         # Check this doc's section in the config file to determine which of its keys we want.
         for template_key, doc_keys in self.config[section_tag].items():
+
             # Document keys can be a comma-separated list. Split and strip off whitespace.
             for doc_key in [x.strip() for x in doc_keys.split(',')]:
                 # Hack: we don't want to process the user_metadata key here.
@@ -593,10 +715,16 @@ class MetaMapper:
                     continue
 
                 # Get the value of the doc_key in the current document. If None, skip.
-                curr_doc_val = self.__get_curr_doc_val(curr_doc, doc_key)
+                curr_doc_val = self.__get_curr_doc_val(context, curr_doc, doc_key)
                 if not curr_doc_val:
                     continue
 
+                # A value set aside for a key that wasn't asked for has to be converted after all,
+                # to be compared with this one.
+                if template_key in context.unconverted_vals:
+                    new_doc[template_key] = self.__get_converted_val(
+                        template_key, context.unconverted_vals.pop(template_key))
+
                 # If the new doc already has a value for this key, but the curr doc has a different
                 # value, and both are not None, raise a ValueError (To be caught and logged, not to
                 # crash the program.) 
@@ -610,20 +738,13 @@ class MetaMapper:
 
                 if template_key in new_doc and new_doc[template_key] == None:
 
-                    # Any dates must converted into a uniform format
-                    if re.match(self.date_key_pattern, template_key):
-                        curr_doc_val = self.__get_converted_date(curr_doc_val)
-
-                    # Manager user_id must be looked up in the SystemGroupsFinder
-                    if template_key == self.manager_user_id_key or template_key == self.user_id_key:
-                        target_key = self.sgf_manager_userid
-
-                        new_doc[template_key] = self.system_groups_finder.get_other_info_from_group(
-                            target_key, curr_doc_val, target_key)
-
+                    # Keys that weren't asked for still take part in the conflict checks above,
+                    # so they stop a doc's mapping just as they would in a full mapping. Their
+                    # date parsing and lookups are skipped unless a comparison needs them.
+                    if self.__wants(fields, template_key):
+                        new_doc[template_key] = self.__get_converted_val(template_key, curr_doc_val)
                     else:
-
-                        new_doc[template_key] = curr_doc_val
+                        context.unconverted_vals[template_key] = curr_doc_val
 
 
     def __adjust_source_path(self, new_doc):
@@ -657,6 +778,118 @@ class MetaMapper:
                 new_doc[self.source_path_key] = new_src_path
 
 
+    def __build_doc(self, context, archive_dir, docs, fields):
+
+        """
+
+        Build a new doc from a directory's metadata docs, doing only the work needed for the
+        requested fields.
+
+        Parameters:
+            context (MappingContext): State for the document being built.
+            archive_dir (str): The directory the docs were read from.
+            docs (list): (section_tag, curr_doc) tuples of the useable docs, normalized.
+            fields (frozenset): Template keys to compute, or None for all of them.
+
+        Returns: (dict): The new doc, with only the requested keys if fields were given.
+
+        """
+
+        # The snapshot version can only be given once every group lookup has run and hit, so
+        # asking for it means doing the lookups, even for fields that weren't asked for.
+        requested_fields = fields
+        if (fields is not None and self.group_snapshot_version
+                and self.group_snapshot_version_key in fields):
+            fields = fields | self.lookup_fields
+
+        context.snapshot_missed = False
+        snapshot_misses = self.__get_snapshot_misses()
+
+        # Map the fields of the docs. This depends only on what's in them, not on the directory.
+        new_doc = self.__map_docs(context, archive_dir, docs, fields)
+
+        # Add archive_path if needed
+        if self.__wants(fields, self.archive_path_key):
+            self.__add_archive_path(context, new_doc, archive_dir)
+
+        # Add the archived size
+        if self.__wants(fields, self.archived_size_key):
+            with self.__stage("archived_size"):
+                self.__add_archived_size(context, new_doc, archive_dir)
+
+        # Add the archival status
+        if self.__wants(fields, self.archival_status_key):
+            self.__add_archival_status(context, new_doc, archive_dir)
+
+        # Add date if needed
+        if self.__wants(fields, self.date_key):
+            self.__add_date(context, new_doc, archive_dir)
+
+        # Add system groups if needed
+        if self.__wants(fields, self.system_groups_key):
+            with self.__stage("groups_from_path"):
+                self.__add_groups_from_path(context, new_doc, archive_dir)
+
+        with self.__stage("finish"):
+            # Make any needed correcttions/adjustments to the source path
+            if self.__wants(fields, self.source_path_key):
+                self.__adjust_source_path(new_doc)
+
+            # Add any known constants
+            self.__add_default_vals(new_doc, fields)
+
+            # Record which group snapshot was used, if any, unless it couldn't answer every lookup
+            if self.__get_snapshot_misses() != snapshot_misses:
+                context.snapshot_missed = True
+            if self.__wants(fields, self.group_snapshot_version_key):
+                self.__add_group_snapshot_version(context, new_doc)
+
+        if requested_fields is not None:
+            new_doc = {key: val for key, val in new_doc.items() if key in requested_fields}
+
+        return new_doc
+
+
+    def __check_fields(self, fields):
+
+        """
+
+        Check that every requested field is one a new doc can have.
+
+        Parameters: fields (iterable): Template keys, or None for all of them.
+
+        Returns: (frozenset): The fields, or None for all of them.
+
+        """
+
+        if fields is None:
+            return None
+
+        # The group snapshot version may be asked for even without a snapshot. It's just left out.
+        fields = frozenset(fields)
+        unknown = fields.difference(self.get_field_names(), [self.group_snapshot_version_key])
+        if unknown:
+            raise ValueError(f"Unknown fields: {', '.join(sorted(unknown))}")
+        return fields
+
+
+    def __copy_mapped_doc(self, new_doc):
+
+        """
+
+        Copy a mapped doc for the memo. Later stages only replace top-level values, so copying
+        the lists and dicts among them, one level deep, is enough to keep the copies apart.
+
+        Parameters: new_doc (dict): A doc returned by or kept for __map_docs.
+
+        Returns: (dict): The copy.
+
+        """
+
+        return {key: val.copy() if isinstance(val, (list, dict)) else val
+                for key, val in new_doc.items()}
+
+
     def __expand_dirname_for_filename(self, doc_filename, archive_dir):
 
         """
@@ -729,13 +962,42 @@ class MetaMapper:
         return new_dt_str
 
 
-    def __get_curr_doc(self, archive_dir, doc_filename):
+    def __get_converted_val(self, template_key, curr_doc_val):
+
+        """
+
+        Convert a value from an old doc into the form it takes in the new doc.
+
+        Parameters:
+            template_key (str): The template key the value is for.
+            curr_doc_val: The value in the old doc.
+
+        Returns: The value for the new doc.
+
+        """
+
+        # Any dates must converted into a uniform format
+        if re.match(self.date_key_pattern, template_key):
+            curr_doc_val = self.__get_converted_date(curr_doc_val)
+
+        # Manager user_id must be looked up in the SystemGroupsFinder
+        if template_key == self.manager_user_id_key or template_key == self.user_id_key:
+            target_key = self.sgf_manager_userid
+
+            return self.system_groups_finder.get_other_info_from_group(
+                target_key, curr_doc_val, target_key)
+
+        return curr_doc_val
+
+
+    def __get_curr_doc(self, context, archive_dir, doc_filename):
 
         """"
         
         Seek the given file and load it as json with snake_case keys.
 
         Parameters:
+            context (MappingContext): State for the document being built.
             archive_dir (str): Absolute path of the directory being searched.
             doc_filename (str): Name of metadata json file to look for in the directory.
 
@@ -743,26 +1005,29 @@ class MetaMapper:
 
         """
 
-        # Clear any saved sub-dictionaries from previous documents
-        self.sub_dicts = {}
-
         # Look for doc
         doc_filepath = os.path.join(archive_dir, doc_filename)
-        if not os.path.isfile(doc_filepath):
+        if not self.io_scheduler.run(doc_filepath, os.path.isfile, doc_filepath):
             # Directory does not have a metadata doc with this name.
             return None
 
+        # Read the file
+        try:
+            doc_text = self.io_scheduler.run(doc_filepath, self.__read_file, doc_filepath)
+        except:
+            return None
+
+        if self.memory_profiler:
+            self.memory_profiler.note_input(doc_filepath, len(doc_text))
+
         # Load as json
         try:
-            with open(doc_filepath) as f:
-                curr_doc = json.load(f)
+            curr_doc = json.loads(doc_text)
         except json.decoder.JSONDecodeError as e:
             # A rare few of the jsons in the archive were hand-made and malformed. Specifically, 
-            # they are missing a closing brace. Load the file as a string, add the close brace, 
-            # then load the string as json.
+            # they are missing a closing brace. Add the close brace, then load the string as json.
             try:
-                with open(doc_filepath) as f:
-                    curr_doc = json.loads(f.read() + '}')
+                curr_doc = json.loads(doc_text + '}')
             except:
                 # If it still didn't work, skip
                 return None
@@ -775,13 +1040,14 @@ class MetaMapper:
         return curr_doc
         
 
-    def __get_curr_doc_val(self, curr_doc, doc_key):
+    def __get_curr_doc_val(self, context, curr_doc, doc_key):
 
         """
 
         Get the value for a key in a given document.
 
         Parameters:
+            context (MappingContext): State for the document being built.
             curr_doc (dict): The current document.
             doc_key (str): The document key from the config file.
 
@@ -812,13 +1078,132 @@ class MetaMapper:
    
         # We'll need to load the sub-dict with alll its keys in snake_case. Also, we may need
         # this sub_dict on subsequent calls, so we want to save the results.
-        if top_key not in self.sub_dicts:
-            self.sub_dicts[top_key] = { self.__to_snake_case(k): v for k, v in curr_doc[top_key].items() }        
+        if top_key not in context.sub_dicts:
+            context.sub_dicts[top_key] = { self.__to_snake_case(k): v for k, v in curr_doc[top_key].items() }        
 
-        val = self.sub_dicts[top_key][sub_key]
+        val = context.sub_dicts[top_key][sub_key]
         return val
 
 
+    def __get_snapshot_misses(self):
+
+        """
+
+        Get the number of lookups in this thread that the group snapshot couldn't answer.
+
+        Parameters: None
+
+        Returns: (int): Misses so far, or 0 if no snapshot is used.
+
+        """
+
+        get_thread_misses = getattr(self.system_groups_finder, "get_thread_misses", None)
+        return get_thread_misses() if get_thread_misses else 0
+
+
+    def __is_dir(self, context, archive_dir):
+
+        """
+
+        Check whether the archive dir is a valid directory, only asking the filesystem once per document.
+
+        Parameters:
+            context (MappingContext): State for the document being built.
+            archive_dir (str): A directory in the archive
+
+        Returns: (bool): True if archive_dir is a directory.
+
+        """
+
+        if context.archive_dir_exists is None:
+            context.archive_dir_exists = self.io_scheduler.run(archive_dir, os.path.isdir, archive_dir)
+        return context.archive_dir_exists
+
+
+    def __map_docs(self, context, archive_dir, docs, fields):
+
+        """
+
+        Map the fields of a directory's metadata docs into a new doc: values from each doc,
+        user metadata, and groups found in the docs.
+
+        The result depends only on the docs' contents, so it's memoized by section tag and
+        digest of each doc. Directories carrying identical docs only pay for mapping once.
+
+        Parameters:
+            context (MappingContext): State for the document being built.
+            archive_dir (str): The directory the docs were read from. Only used in warnings.
+            docs (list): (section_tag, curr_doc) tuples of the useable docs, normalized.
+            fields (frozenset): Template keys to fill in, or None for all of them.
+
+        Returns: (dict): The new doc, with the fields that come from the docs populated.
+
+        """
+
+        memo_key = None
+        if self.memo:
+            memo_key = (fields,) + tuple(
+                (section_tag, get_doc_digest(curr_doc)) for section_tag, curr_doc in docs)
+            memoized = self.memo.get(memo_key)
+            if memoized:
+                new_doc, user_metadata_index, warnings, context.snapshot_missed = memoized
+                new_doc = self.__copy_mapped_doc(new_doc)
+
+                # User metadata is the caller's own doc, not the one the memo was built from.
+                if user_metadata_index is not None:
+                    new_doc[self.user_metadata_key] = docs[user_metadata_index][1]
+
+                # Each directory still gets its warnings logged.
+                for warning in warnings:
+                    print(f"Key error for {archive_dir}:new_doc {warning}", file=sys.stderr)
+                return new_doc
+
+        # Copy the template into the new doc that will be returned after it's populated.
+        new_doc = self.get_blank_template()
+        context.unconverted_vals = {}
+        warnings = []
+        snapshot_misses = self.__get_snapshot_misses()
+
+        for section_tag, curr_doc in docs:
+
+            # Sub-dictionaries saved while mapping one doc don't apply to the next.
+            context.sub_dicts = {}
+
+            with self.__stage("map_fields"):
+                # Add vals from curr doc to new doc
+                try:
+                    self.__add_vals_from_curr_doc(context, new_doc, section_tag, curr_doc, fields)
+                except ValueError as e:
+                    warnings.append(str(e))
+                    print(f"Key error for {archive_dir}:new_doc {str(e)}", file=sys.stderr)
+
+                # Tuck curr doc into user_data field, if specified in the config file.
+                if self.__wants(fields, self.user_metadata_key):
+                    self.__add_user_metadata(new_doc, section_tag, curr_doc)
+
+            # Add the system groups
+            if self.__wants(fields, self.system_groups_key):
+                with self.__stage("groups_from_doc"):
+                    self.__add_groups_from_doc(context, new_doc, curr_doc)
+
+        # Directories that reuse this mapping reuse its group lookups, hits or misses.
+        if self.__get_snapshot_misses() != snapshot_misses:
+            context.snapshot_missed = True
+
+        if self.memo:
+            # Leave out user metadata, which holds a whole doc, and remember which doc it was.
+            memo_doc = dict(new_doc)
+            user_metadata_index = None
+            for i, (section_tag, curr_doc) in enumerate(docs):
+                if new_doc.get(self.user_metadata_key) is curr_doc:
+                    user_metadata_index = i
+                    memo_doc[self.user_metadata_key] = None
+            self.memo.put(memo_key, (self.__copy_mapped_doc(memo_doc), user_metadata_index,
+                                     warnings, context.snapshot_missed))
+
+        return new_doc
+
+
     def __prune_keys(self, curr_doc):
 
         """
@@ -839,6 +1224,101 @@ class MetaMapper:
                 curr_doc[self.sub_dict_to_prune].pop(bad_key, None)
 
 
+    def __read_docs(self, context, archive_dir):
+
+        """
+
+        Read and normalize the metadata docs in a directory that the config has a section for.
+
+        Parameters:
+            context (MappingContext): State for the document being built.
+            archive_dir (str): Absolute path to a directory in the archive.
+
+        Returns:
+            docs (list): (section_tag, curr_doc) tuples in the order of the config, OR error
+                string starting with "ERROR"
+
+        """
+
+        # Find which kind of metadata to expect from the directory path.
+        category_tag = self.__get_category_tag(archive_dir)
+        if not category_tag:
+            # This kind of metadata is not yet handled.
+            return "ERROR: could not determine metadata category"
+
+        # Seek and read any metadata docs in the directory named in the config file. Keep
+        # each useable one with its section tag, in the order of the config.
+        docs = []
+        for doc_tag, doc_filename in self.config["doc_names"].items():
+            
+            # If the directory name is part of the metadata filename, expand it.
+            doc_filename = self.__expand_dirname_for_filename(doc_filename, archive_dir)
+
+            # Load json doc with keys converted to snake_case.
+            with self.__stage("read_doc"):
+                curr_doc = self.__get_curr_doc(context, archive_dir, doc_filename)
+
+            if not curr_doc:
+                # doc not found in this directory
+                continue
+
+            with self.__stage("normalize_doc"):
+                # Immediately remove unwanted keys
+                self.__prune_keys(curr_doc)
+
+                # Strip any dollar signs ('$') from the keys.
+                curr_doc = self.__strip_dollar_signs_from_keys(curr_doc)
+
+            # Get the section of the config file to seek by combining the category and doc tags.
+            section_tag = category_tag + '_' + doc_tag
+            if section_tag not in self.config:
+                # This kind of metadata doc is not yet handled for this category
+                continue
+
+            # We have found a useable doc
+            context.useable_doc_found = True
+            docs.append((section_tag, curr_doc))
+
+        # Do nothing if the archive dir had no useable metadata document
+        if not context.useable_doc_found:
+            return "ERROR: No useable metata doc found"
+
+        return docs
+
+
+    def __read_file(self, filepath):
+
+        """
+
+        Read a whole text file.
+
+        Parameters: filepath (str): The file to read.
+
+        Returns: (str): The file's contents.
+
+        """
+
+        with open(filepath) as f:
+            return f.read()
+
+
+    def __stage(self, name):
+
+        """
+
+        Get a context manager that measures a stage of mapping, if memory profiling is on.
+
+        Parameters: name (str): Name of the stage.
+
+        Returns: A context manager.
+
+        """
+
+        if self.memory_profiler:
+            return self.memory_profiler.stage(name)
+        return nullcontext()
+
+
     def __strip_dollar_signs_from_keys(self, curr_doc):
 
         """
@@ -915,3 +1395,20 @@ class MetaMapper:
             new_val += val[i].lower()
         
         return new_val
+
+
+    def __wants(self, fields, key):
+
+        """
+
+        Check whether a field was asked for.
+
+        Parameters:
+            fields (frozenset): Template keys to compute, or None for all of them.
+            key (str): A template key.
+
+        Returns: (bool): True if the key should be computed.
+
+        """
+
+        return fields is None or key in fields
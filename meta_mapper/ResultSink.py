@@ -0,0 +1,179 @@
+"""
+    Destinations for documents produced by the mapper during batch runs.
+"""
+
+import json
+import os
+import sys
+
+
+class ResultSink:
+
+    """
+    Base class for destinations of mapped documents. Subclasses must implement write().
+    """
+
+    def write(self, archive_dir, new_doc):
+
+        """
+
+        Write one mapped document.
+
+        Parameters:
+            archive_dir (str): The directory the document was mapped from.
+            new_doc (dict): The mapped document.
+
+        Returns: None
+
+        """
+
+        raise NotImplementedError
+
+
+    def flush(self):
+
+        """
+
+        Make sure every document written so far has reached its destination.
+
+        Parameters: None
+
+        Returns: None. Raises if any document couldn't be written.
+
+        """
+
+        pass
+
+
+    def close(self):
+
+        """
+
+        Flush and release anything held by the sink.
+
+        Parameters: None
+
+        Returns: None
+
+        """
+
+        pass
+
+
+    def __enter__(self):
+        return self
+
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+
+class JsonLinesSink(ResultSink):
+
+    """
+    Write each mapped document as one line of json to a file, or to stdout if the filename is '-'.
+    """
+
+    def __init__(self, filename):
+
+        """
+
+        Open the output file.
+
+        Parameters: filename (str): File to write to, or '-' for stdout.
+
+        """
+
+        if filename == '-':
+            self.out = sys.stdout
+            self.owns_out = False
+        else:
+            self.out = open(filename, 'w')
+            self.owns_out = True
+
+
+    def write(self, archive_dir, new_doc):
+        self.out.write(json.dumps(new_doc) + '\n')
+
+
+    def flush(self):
+        self.out.flush()
+
+
+    def close(self):
+        if self.owns_out:
+            self.out.close()
+        else:
+            self.out.flush()
+
+
+class DirectorySink(ResultSink):
+
+    """
+    Write each mapped document to its own json file in an output directory. The filename is
+    derived from the archive directory's path.
+    """
+
+    def __init__(self, out_dir):
+
+        """
+
+        Create the output directory if needed.
+
+        Parameters: out_dir (str): Directory to write documents into.
+
+        """
+
+        self.out_dir = out_dir
+        os.makedirs(out_dir, exist_ok=True)
+
+
+    def write(self, archive_dir, new_doc):
+
+        # Flatten the path into a single filename, e.g. /archive/GT/2020/x -> archive_GT_2020_x.json
+        filename = archive_dir.strip(os.sep).replace(os.sep, '_') + ".json"
+        with open(os.path.join(self.out_dir, filename), 'w') as f:
+            json.dump(new_doc, f, indent=4)
+
+
+class NullSink(ResultSink):
+
+    """
+    Discard every document. Useful for timing runs and for checking which directories fail.
+    """
+
+    def write(self, archive_dir, new_doc):
+        pass
+
+
+def open_sink(kind, target, key_field="archived_path", collection="metadata", batch_size=500):
+
+    """
+
+    Create a sink by name.
+
+    Parameters:
+        kind (str): One of "jsonl", "dir", "null", "sqlite" or "mongo".
+        target (str): Filename or directory for the sink, or connection string for "mongo";
+            ignored by "null".
+        key_field (str): The document field to upsert on, for "sqlite" and "mongo".
+        collection (str): Table or collection to upsert into, for "sqlite" and "mongo".
+        batch_size (int): Documents per bulk upsert, for "sqlite" and "mongo".
+
+    Returns: (ResultSink): The new sink.
+
+    """
+
+    if kind == "jsonl":
+        return JsonLinesSink(target)
+    if kind == "dir":
+        return DirectorySink(target)
+    if kind == "null":
+        return NullSink()
+    if kind == "sqlite":
+        from meta_mapper.UpsertSink import SqliteUpsertSink
+        return SqliteUpsertSink(target, table=collection, key_field=key_field, batch_size=batch_size)
+    if kind == "mongo":
+        from meta_mapper.UpsertSink import MongoUpsertSink
+        return MongoUpsertSink(target, collection=collection, key_field=key_field, batch_size=batch_size)
+    raise ValueError(f"Unknown sink type: {kind}")
@@ -0,0 +1,466 @@
+"""
+    Sinks that upsert mapped documents into a document store in bulk, keyed by archived path.
+
+    Documents are collected into batches and written by a background thread over one long-lived
+    connection, so ingest overlaps with mapping instead of costing a round trip per document.
+    The queue of batches waiting to be written is bounded: when the store falls behind, write()
+    blocks until there is room, rather than buffering without limit. Because every write is an
+    upsert on the archived path, a batch that fails part way can be retried as a whole without
+    creating duplicates. flush() waits until the store has everything written so far.
+"""
+
+from collections import deque
+import json
+import sqlite3
+import threading
+import time
+
+from meta_mapper.ResultSink import ResultSink
+
+
+class BulkUpsertSink(ResultSink):
+
+    """
+    Base class for sinks that upsert batches of documents into a store. Subclasses must
+    implement _upsert_batch(), and may override _is_retryable() and _close_store().
+
+    Besides whole documents, these sinks accept the {"op": "insert"} and {"op": "update"} records
+    written by DeltaSink, so that only changed fields are sent to the store.
+    """
+
+    def __init__(self, key_field="archived_path", batch_size=500, max_pending_batches=4,
+                 flush_interval=2.0, max_retries=5, retry_delay=0.5):
+
+        """
+
+        Start the writer thread. The subclass must have connected to its store before this is called.
+
+        Parameters:
+            key_field (str): The document field that identifies a document in the store.
+            batch_size (int): Number of documents per bulk write.
+            max_pending_batches (int): Number of full batches that may wait for the writer before
+                write() blocks.
+            flush_interval (float): Seconds after which a partly filled batch is sent anyway,
+                so that a slow run still reaches the store.
+            max_retries (int): Number of times to retry a batch that failed with a transient error.
+            retry_delay (float): Seconds to wait before the first retry. Doubles with each retry.
+
+        """
+
+        self.key_field = key_field
+        self.batch_size = max(1, batch_size)
+        self.max_pending_batches = max(1, max_pending_batches)
+        self.flush_interval = flush_interval
+        self.max_retries = max_retries
+        self.retry_delay = retry_delay
+
+        # Records in the batch being filled, keyed by document key. A document mapped twice in
+        # one batch is only written once, with its latest contents.
+        self.batch = {}
+        self.batch_started = time.monotonic()
+
+        # Batches handed to the writer, oldest first. The writer thread hands over a stale batch
+        # itself, so everything here, including the batch being filled, is guarded by one
+        # condition. That keeps batches in order, so an older version of a document can never
+        # overwrite a newer one.
+        self.pending = deque()
+        self.writing = False
+        self.closing = False
+        self.condition = threading.Condition()
+
+        self.num_written = 0
+        self.num_batches = 0
+        self.num_retries = 0
+        self.seconds_blocked = 0.0
+        self.error = None
+
+        self.writer = threading.Thread(target=self.__run_writer, name="upsert-writer", daemon=True)
+        self.writer.start()
+
+
+    def write(self, archive_dir, new_doc):
+
+        self.__check_error()
+
+        # Delta records carry the key at the top level too. Fall back to the directory we mapped.
+        key = new_doc.get(self.key_field) or archive_dir
+
+        with self.condition:
+            if not self.batch:
+                self.batch_started = time.monotonic()
+            self.batch[key] = new_doc
+            if len(self.batch) >= self.batch_size or self.__is_batch_stale():
+                self.__send_batch()
+
+
+    def flush(self):
+
+        # Wait until the writer has stored every batch, including the one being filled.
+        with self.condition:
+            self.__send_batch()
+            while (self.pending or self.writing) and not self.error:
+                self.condition.wait()
+        self.__check_error()
+
+
+    def close(self):
+
+        if self.writer.is_alive():
+            with self.condition:
+                self.__send_batch()
+                self.closing = True
+                self.condition.notify_all()
+            self.writer.join()
+        self._close_store()
+        self.__check_error()
+
+
+    def get_summary(self):
+
+        """
+
+        Describe what was written to the store.
+
+        Parameters: None
+
+        Returns: (str): One line summary.
+
+        """
+
+        return (f"Store: {self.num_written} documents upserted in {self.num_batches} batches, "
+                f"{self.num_retries} retries, {self.seconds_blocked:.1f}s waiting on the store")
+
+
+
+    """
+
+    METHODS FOR SUBCLASSES
+
+    """
+
+    def _upsert_batch(self, records):
+
+        """
+
+        Upsert one batch of documents. Must be safe to repeat, since a failed batch is retried.
+
+        Parameters: records (list): (key, record) tuples. A record is a mapped document, or an
+            {"op": "insert"} or {"op": "update"} record from DeltaSink.
+
+        Returns: None
+
+        """
+
+        raise NotImplementedError
+
+
+    def _is_retryable(self, error):
+
+        """
+
+        Decide whether a failed batch is worth retrying.
+
+        Parameters: error (Exception): The exception raised by _upsert_batch().
+
+        Returns: (bool): True for transient errors, e.g. a lost connection or a locked database.
+
+        """
+
+        return False
+
+
+    def _close_store(self):
+
+        """
+
+        Release the connection to the store. Called once the writer thread has finished.
+
+        Parameters: None
+
+        Returns: None
+
+        """
+
+        pass
+
+
+
+    """
+
+    PRIVATE METHODS
+
+    """
+
+    def __check_error(self):
+
+        """
+
+        Raise if the writer thread failed to store a batch.
+
+        Parameters: None
+
+        Returns: None
+
+        """
+
+        if self.error:
+            raise RuntimeError(f"Writing to the store failed: {self.error}") from self.error
+
+
+    def __is_batch_stale(self):
+
+        """
+
+        Check whether the batch being filled has waited long enough to be sent part full.
+        The caller must hold self.condition.
+
+        Parameters: None
+
+        Returns: (bool): True if the batch should be sent now.
+
+        """
+
+        return bool(self.batch) and time.monotonic() - self.batch_started >= self.flush_interval
+
+
+    def __run_writer(self):
+
+        """
+
+        The body of the writer thread: write batches as they're handed over, and send a partly
+        filled batch once it has waited flush_interval, until told to stop.
+
+        Parameters: None
+
+        Returns: None
+
+        """
+
+        while True:
+            with self.condition:
+                self.writing = False
+                self.condition.notify_all()
+
+                while not self.pending:
+                    if self.closing:
+                        return
+                    if self.__is_batch_stale():
+                        # write() isn't being called, so send the batch on its behalf.
+                        self.__send_batch()
+                        break
+                    if self.batch:
+                        timeout = self.batch_started + self.flush_interval - time.monotonic()
+                    else:
+                        timeout = self.flush_interval
+                    self.condition.wait(timeout)
+
+                records = self.pending.popleft()
+                self.writing = True
+                self.condition.notify_all()
+
+            try:
+                self.__upsert_with_retries(records)
+            except Exception as e:
+                with self.condition:
+                    # Drop whatever is still waiting, so write() never blocks for good.
+                    self.error = e
+                    self.pending.clear()
+
+
+    def __send_batch(self):
+
+        """
+
+        Hand the batch being filled to the writer thread, waiting if too many are already
+        pending. The caller must hold self.condition.
+
+        Parameters: None
+
+        Returns: None
+
+        """
+
+        if not self.batch:
+            return
+
+        start = time.monotonic()
+        while len(self.pending) >= self.max_pending_batches and not self.error:
+            self.condition.wait()
+        self.seconds_blocked += time.monotonic() - start
+
+        # After a failure nothing more is written, so there's no point queueing the batch.
+        if not self.error:
+            self.pending.append(list(self.batch.items()))
+            self.condition.notify_all()
+        self.batch = {}
+        self.batch_started = time.monotonic()
+
+
+    def __upsert_with_retries(self, records):
+
+        """
+
+        Upsert a batch, retrying transient failures with exponential backoff.
+
+        Parameters: records (list): (key, record) tuples.
+
+        Returns: None
+
+        """
+
+        for attempt in range(self.max_retries + 1):
+            try:
+                self._upsert_batch(records)
+                break
+            except Exception as e:
+                if attempt == self.max_retries or not self._is_retryable(e):
+                    raise
+                self.num_retries += 1
+                time.sleep(self.retry_delay * 2 ** attempt)
+
+        self.num_written += len(records)
+        self.num_batches += 1
+
+
+class SqliteUpsertSink(BulkUpsertSink):
+
+    """
+    Upsert documents into a table of a SQLite database, as json keyed by archived path.
+    """
+
+    def __init__(self, filename, table="metadata", **kwargs):
+
+        """
+
+        Open (or create) the database and table.
+
+        Parameters:
+            filename (str): The SQLite database file.
+            table (str): Table to upsert into. Created if needed, with columns (key, doc).
+            kwargs: Passed on to BulkUpsertSink.
+
+        """
+
+        if not table.isidentifier():
+            raise ValueError(f"Invalid table name: {table}")
+        self.table = table
+
+        # Only the writer thread uses the connection once it has started.
+        self.conn = sqlite3.connect(filename, timeout=30, check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute(f"CREATE TABLE IF NOT EXISTS {table} (key TEXT PRIMARY KEY, doc TEXT NOT NULL)")
+        self.conn.commit()
+
+        super().__init__(**kwargs)
+
+
+    def _upsert_batch(self, records):
+
+        rows = []
+        for key, record in records:
+            if record.get("op") == "update":
+                # Apply the patch to the stored document. A document missing from the store
+                # gets whatever fields the patch sets.
+                row = self.conn.execute(f"SELECT doc FROM {self.table} WHERE key = ?", (key,)).fetchone()
+                doc = json.loads(row[0]) if row else {self.key_field: key}
+                doc.update(record["set"])
+                for field in record["unset"]:
+                    doc.pop(field, None)
+            elif record.get("op") == "insert":
+                doc = record["doc"]
+            else:
+                doc = record
+            rows.append((key, json.dumps(doc)))
+
+        # One transaction per batch, so a failed batch leaves nothing behind to duplicate.
+        with self.conn:
+            self.conn.executemany(f"INSERT OR REPLACE INTO {self.table} VALUES (?, ?)", rows)
+
+
+    def _is_retryable(self, error):
+        # e.g. "database is locked" while another process holds a write lock
+        return isinstance(error, sqlite3.OperationalError)
+
+
+    def _close_store(self):
+        self.conn.close()
+
+
+class MongoUpsertSink(BulkUpsertSink):
+
+    """
+    Upsert documents into a MongoDB collection (or any store speaking the MongoDB protocol),
+    keyed by archived path, using unordered bulk writes.
+    """
+
+    def __init__(self, uri, collection="metadata", database=None, **kwargs):
+
+        """
+
+        Connect to the store, and make sure the collection has a unique index on the key field.
+
+        Parameters:
+            uri (str): MongoDB connection string, e.g. mongodb://localhost:27017/meta_mapper
+            collection (str): Collection to upsert into.
+            database (str): Database to use. Defaults to the one named in the URI, or "meta_mapper".
+            kwargs: Passed on to BulkUpsertSink.
+
+        """
+
+        import pymongo
+
+        self.pymongo = pymongo
+
+        # The client keeps a pool of connections that is reused for every batch.
+        self.client = pymongo.MongoClient(uri)
+        if database:
+            db = self.client[database]
+        else:
+            db = self.client.get_default_database("meta_mapper")
+        self.collection = db[collection]
+
+        key_field = kwargs.get("key_field", "archived_path")
+        self.collection.create_index(key_field, unique=True)
+
+        super().__init__(**kwargs)
+
+
+    def _upsert_batch(self, records):
+
+        ops = []
+        for key, record in records:
+            key_filter = {self.key_field: key}
+            if record.get("op") == "update":
+                update = {}
+                if record["set"]:
+                    update["$set"] = record["set"]
+                if record["unset"]:
+                    update["$unset"] = {field: "" for field in record["unset"]}
+                if update:
+                    ops.append(self.pymongo.UpdateOne(key_filter, update, upsert=True))
+            elif record.get("op") == "insert":
+                ops.append(self.pymongo.ReplaceOne(key_filter, record["doc"], upsert=True))
+            else:
+                ops.append(self.pymongo.ReplaceOne(key_filter, record, upsert=True))
+
+        if ops:
+            self.collection.bulk_write(ops, ordered=False)
+
+
+    def _is_retryable(self, error):
+
+        errors = self.pymongo.errors
+        if isinstance(error, (errors.AutoReconnect, errors.NetworkTimeout)):
+            return True
+
+        # Concurrent upserts of a new key can race on the unique index. Retrying turns the
+        # loser into an update.
+        if isinstance(error, errors.BulkWriteError):
+            write_errors = error.details.get("writeErrors", [])
+            return bool(write_errors) and all(e.get("code") == 11000 for e in write_errors)
+
+        return False
+
+
+    def _close_store(self):
+        self.client.close()
@@ -0,0 +1,8 @@
+# Allow running the command line tool as "python -m meta_mapper".
+
+import sys
+
+from meta_mapper.cli import main
+
+if __name__ == "__main__":
+    sys.exit(main())
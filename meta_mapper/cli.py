@@ -0,0 +1,392 @@
+"""
+    Command line entry point for the meta_mapper.
+
+    Example:
+        $ meta-mapper map --crawl /archive/GT/2020 --workers 16 --output docs.jsonl
+        $ find /archive/faculty -name metadata.json -printf '%h\\n' | meta-mapper map - --workers 8
+        $ meta-mapper snapshot --crawl /archive --workers 16 --output groups.snap --version 2024-06
+        $ meta-mapper serve --socket /run/meta_mapper.sock --workers 4
+"""
+
+import argparse
+from datetime import datetime
+import sys
+
+from system_groups_finder import SystemGroupsFinder
+
+from meta_mapper.BatchProgress import BatchProgress
+from meta_mapper.BatchRunner import BatchRunner
+from meta_mapper.CostEstimator import CostEstimator, read_archived_sizes
+from meta_mapper.DeltaIndex import DeltaIndex, DeltaSink
+from meta_mapper.DirectoryCrawler import DirectoryCrawler
+from meta_mapper.GroupSnapshot import RecordingGroupsFinder
+from meta_mapper.MappingService import MappingService
+from meta_mapper.MetaMapper import get_config, get_template_keys
+from meta_mapper.ResultSink import NullSink, open_sink
+
+
+def get_parser():
+
+    """
+
+    Build the argument parser for all subcommands.
+
+    Parameters: None
+
+    Returns: (ArgumentParser): The parser.
+
+    """
+
+    parser = argparse.ArgumentParser(
+        prog="meta-mapper",
+        description="Map fields in existing metadata documents to those in a new, standardized template.")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    map_parser = subparsers.add_parser("map", help="Map a batch of archive directories.")
+    _add_input_args(map_parser)
+    map_parser.add_argument("--executor", choices=["process", "thread"], default="process",
+                            help="Run workers as processes, each with its own mapper, or as threads "
+                                 "sharing one mapper (default: process).")
+    map_parser.add_argument("--sink", choices=["jsonl", "dir", "null", "sqlite", "mongo"], default="jsonl",
+                            help="Kind of output. sqlite and mongo upsert documents in bulk, keyed "
+                                 "by archived path (default: jsonl).")
+    map_parser.add_argument("--output", default='-',
+                            help="Output file for jsonl, directory for dir, database file for sqlite, "
+                                 "or connection string for mongo (default: stdout).")
+    map_parser.add_argument("--collection", default="metadata",
+                            help="Table or collection to upsert into, for sqlite and mongo "
+                                 "(default: metadata).")
+    map_parser.add_argument("--batch-size", type=int, default=500, metavar="N",
+                            help="Documents per bulk upsert, for sqlite and mongo (default: 500).")
+    map_parser.add_argument("--errors", metavar="FILE",
+                            help="Write one json line per failed directory to FILE.")
+    map_parser.add_argument("--delta-index", metavar="FILE",
+                            help="Emit only new documents and patches for changed ones, compared "
+                                 "against the documents recorded in the SQLite index FILE. The "
+                                 "index is updated with this run's documents.")
+    map_parser.add_argument("--previous", metavar="JSONL",
+                            help="Load a previous run's jsonl output into the --delta-index first.")
+    map_parser.add_argument("--order", choices=["cost", "input"], default="cost",
+                            help="Dispatch the most expensive directories first, or keep the input "
+                                 "order (default: cost). Paths streamed from stdin keep the input order.")
+    map_parser.add_argument("--sizes-from", metavar="JSONL",
+                            help="Estimate costs from the archived sizes in a previous run's jsonl "
+                                 "output. With --delta-index, the sizes in the index are used.")
+    map_parser.add_argument("--group-snapshot", metavar="FILE",
+                            help="Answer group, user and lab lookups from the snapshot FILE instead "
+                                 "of live directory services.")
+    map_parser.add_argument("--fields", metavar="KEY,...",
+                            help="Compute only these template keys, e.g. archived_size or "
+                                 "system_groups,manager_user_id, skipping the reads, lookups and "
+                                 "du walks the others need. The archived path is always included. "
+                                 "Can't be combined with --delta-index or --sink sqlite|mongo.")
+    map_parser.add_argument("--memory-profile", metavar="FILE",
+                            help="Profile memory for each directory and mapping stage, and write a "
+                                 "report of the peaks, top allocation sites and largest inputs to "
+                                 "FILE. Slows the run down; not available with --executor thread.")
+
+    snapshot_parser = subparsers.add_parser(
+        "snapshot", help="Map a batch of directories, recording every group, user and lab lookup "
+                         "into a snapshot file for offline use.")
+    _add_input_args(snapshot_parser)
+    snapshot_parser.add_argument("--output", required=True, metavar="FILE",
+                                 help="Snapshot file to write.")
+    snapshot_parser.add_argument("--version",
+                                 help="Version to record in the snapshot and in documents mapped "
+                                      "with it (default: the current date and time).")
+
+    serve_parser = subparsers.add_parser(
+        "serve", help="Serve mapping requests on a Unix-domain socket from a pool of warm mappers.")
+    serve_parser.add_argument("--socket", required=True, help="Path of the socket to listen on.")
+    serve_parser.add_argument("--workers", type=int, default=4,
+                              help="Number of worker processes (default: 4).")
+    serve_parser.add_argument("--idle-timeout", type=float, default=60.0, metavar="SECONDS",
+                              help="Drop connections idle for this long (default: 60).")
+    serve_parser.add_argument("--group-snapshot", metavar="FILE",
+                              help="Answer group, user and lab lookups from the snapshot FILE "
+                                   "instead of live directory services.")
+
+    return parser
+
+
+def run_map(args):
+
+    """
+
+    Run the "map" subcommand.
+
+    Parameters: args (Namespace): Parsed command line arguments.
+
+    Returns: (int): Exit status: 0 if every directory mapped, 1 if any failed, 2 for bad arguments.
+
+    """
+
+    if args.previous and not args.delta_index:
+        sys.stderr.write("meta-mapper map: --previous requires --delta-index\n")
+        return 2
+    if args.sink in ("sqlite", "mongo") and args.output == '-':
+        sys.stderr.write(f"meta-mapper map: --sink {args.sink} needs --output\n")
+        return 2
+    # Partial documents would replace whole ones in a store, and look like removed fields to the
+    # delta index.
+    if args.fields and args.delta_index:
+        sys.stderr.write("meta-mapper map: --fields can't be used with --delta-index\n")
+        return 2
+    if args.fields and args.sink in ("sqlite", "mongo"):
+        sys.stderr.write(f"meta-mapper map: --fields can't be used with --sink {args.sink}\n")
+        return 2
+    if args.memory_profile and args.executor == "thread" and args.workers > 1:
+        sys.stderr.write("meta-mapper map: --memory-profile can't be used with --executor thread\n")
+        return 2
+
+    config = get_config()
+
+    # Keep the archived path, so partial documents can be matched to their directories.
+    fields = None
+    if args.fields:
+        fields = [key.strip() for key in args.fields.split(',') if key.strip()]
+        known_fields = get_template_keys(config) + [config["format"]["group_snapshot_version_key"]]
+        unknown = [key for key in fields if key not in known_fields]
+        if unknown:
+            sys.stderr.write(f"meta-mapper map: unknown fields: {', '.join(unknown)}\n")
+            return 2
+        fields.append(config["format"]["archive_path_key"])
+
+        # Keep the snapshot version too, so documents with lookups it couldn't answer show up.
+        # The version is only given once all of a document's lookups have run, so this runs them.
+        if args.group_snapshot:
+            fields.append(config["format"]["group_snapshot_version_key"])
+
+    archive_dirs, total, crawl_stats = _get_archive_dirs(args, config)
+
+    delta_index = None
+    if args.delta_index:
+        delta_index = DeltaIndex(args.delta_index, key_field=config["format"]["archive_path_key"])
+        if args.previous:
+            delta_index.load_previous_run(args.previous)
+
+    # Start the expensive directories first. This needs the whole list, so not from stdin.
+    if args.order == "cost" and total is not None:
+        size_key = config["format"]["archived_size_key"]
+        if delta_index:
+            archived_sizes = delta_index.get_archived_sizes(size_key)
+        elif args.sizes_from:
+            archived_sizes = read_archived_sizes(
+                args.sizes_from, config["format"]["archive_path_key"], size_key)
+        else:
+            archived_sizes = {}
+        archive_dirs = CostEstimator(config, archived_sizes, crawl_stats).order(archive_dirs)
+
+    progress = BatchProgress(total=total, num_slowest=args.slowest, live=not args.quiet)
+    error_file = open(args.errors, 'w') if args.errors else None
+
+    sink = open_sink(args.sink, args.output, key_field=config["format"]["archive_path_key"],
+                     collection=args.collection, batch_size=args.batch_size)
+    store_sink = sink
+    if delta_index:
+        sink = DeltaSink(sink, delta_index)
+
+    mapper_kwargs = {}
+    if args.group_snapshot:
+        mapper_kwargs["group_snapshot"] = args.group_snapshot
+
+    try:
+        with sink:
+            runner = BatchRunner(sink, workers=args.workers, progress=progress,
+                                 error_file=error_file, executor=args.executor,
+                                 mapper_kwargs=mapper_kwargs,
+                                 memory_profile=bool(args.memory_profile), fields=fields)
+            num_failed = runner.run(archive_dirs)
+    finally:
+        if error_file:
+            error_file.close()
+
+    progress.write_summary()
+    io_stats = runner.get_io_stats()
+    if io_stats:
+        sys.stderr.write("I/O by mount:\n")
+        for mount, stats in sorted(io_stats.items()):
+            sys.stderr.write(f"  {mount}: limit {stats['limit']}, {stats['completed']} ops, "
+                             f"{stats['errors']} errors, avg {stats['avg_latency']:.4f}s\n")
+    if args.group_snapshot:
+        sys.stderr.write(f"Group snapshot: {runner.num_snapshot_misses} documents had lookups the "
+                         f"snapshot couldn't answer, and were written without its version\n")
+    memo_stats = runner.get_memo_stats()
+    if memo_stats:
+        sys.stderr.write(f"Memo: {memo_stats['hits']} directories reused the mapping of identical "
+                         f"docs, {memo_stats['misses']} were mapped from scratch\n")
+    if args.delta_index:
+        sys.stderr.write(sink.get_summary() + '\n')
+    if args.sink in ("sqlite", "mongo"):
+        sys.stderr.write(store_sink.get_summary() + '\n')
+    if args.memory_profile:
+        with open(args.memory_profile, 'w') as f:
+            runner.memory_report.write(f)
+    return 1 if num_failed else 0
+
+
+def run_snapshot(args):
+
+    """
+
+    Run the "snapshot" subcommand.
+
+    Parameters: args (Namespace): Parsed command line arguments.
+
+    Returns: (int): Exit status.
+
+    """
+
+    archive_dirs, total, _ = _get_archive_dirs(args, get_config())
+    progress = BatchProgress(total=total, num_slowest=args.slowest, live=not args.quiet)
+
+    # Every thread's lookups go through the one recorder, so they all land in the snapshot.
+    recorder = RecordingGroupsFinder(SystemGroupsFinder.SystemGroupsFinder())
+    runner = BatchRunner(NullSink(), workers=args.workers, progress=progress, executor="thread",
+                         mapper_kwargs={"system_groups_finder": recorder})
+    runner.run(archive_dirs)
+    progress.write_summary()
+
+    snapshot_version = args.version or datetime.now().strftime("%Y-%m-%dT%H:%M:%S")
+    num_lookups = recorder.write(args.output, snapshot_version)
+    sys.stderr.write(f"Wrote {num_lookups} lookups to {args.output} (version {snapshot_version})\n")
+    return 0
+
+
+def run_serve(args):
+
+    """
+
+    Run the "serve" subcommand.
+
+    Parameters: args (Namespace): Parsed command line arguments.
+
+    Returns: (int): Exit status.
+
+    """
+
+    mapper_kwargs = {}
+    if args.group_snapshot:
+        mapper_kwargs["group_snapshot"] = args.group_snapshot
+
+    service = MappingService(args.socket, workers=args.workers, mapper_kwargs=mapper_kwargs,
+                             idle_timeout=args.idle_timeout)
+    try:
+        service.serve_forever()
+    except RuntimeError as e:
+        sys.stderr.write(f"meta-mapper serve: {e}\n")
+        return 1
+    except KeyboardInterrupt:
+        pass
+    return 0
+
+
+def main(argv=None):
+
+    """
+
+    Parse the command line and run the requested subcommand.
+
+    Parameters: argv (list): Arguments, not including the program name. Defaults to sys.argv[1:].
+
+    Returns: (int): Exit status.
+
+    """
+
+    args = get_parser().parse_args(argv)
+
+    if args.command == "serve":
+        return run_serve(args)
+
+    if not args.path_files and not args.crawl:
+        sys.stderr.write(f"meta-mapper {args.command}: give at least one PATH_FILE or --crawl ROOT\n")
+        return 2
+
+    if args.command == "map":
+        return run_map(args)
+    if args.command == "snapshot":
+        return run_snapshot(args)
+
+    return 2
+
+
+def _add_input_args(parser):
+
+    """
+
+    Add the arguments shared by subcommands that map a batch of directories.
+
+    Parameters: parser (ArgumentParser): The subcommand's parser.
+
+    Returns: None
+
+    """
+
+    parser.add_argument("path_files", nargs='*', metavar="PATH_FILE",
+                        help="Files listing one directory per line. Use '-' for stdin.")
+    parser.add_argument("--crawl", action="append", default=[], metavar="ROOT",
+                        help="Crawl ROOT for directories holding metadata docs. May be repeated.")
+    parser.add_argument("--workers", type=int, default=1,
+                        help="Number of workers (default: 1).")
+    parser.add_argument("--slowest", type=int, default=10, metavar="N",
+                        help="Number of slowest directories to list in the summary (default: 10).")
+    parser.add_argument("--quiet", action="store_true",
+                        help="Don't show live progress; only the final summary.")
+
+
+def _get_archive_dirs(args, config):
+
+    """
+
+    Gather the directories to map from the path files and crawl roots on the command line.
+
+    Paths from regular files and crawls are collected up front so we can show an ETA.
+    Anything coming from stdin is streamed instead.
+
+    Parameters:
+        args (Namespace): Parsed command line arguments.
+        config (ConfigParser): The meta_mapper config.
+
+    Returns: (tuple): (iterable of directory paths, number of paths or None if not known,
+        dict of (entry_count, metadata_bytes) for each crawled directory)
+
+    """
+
+    crawler = DirectoryCrawler(config)
+    archive_dirs = crawler.read_paths(args.path_files)
+
+    if '-' in args.path_files:
+        return _chain_crawls(archive_dirs, crawler, args.crawl), None, {}
+
+    archive_dirs = list(archive_dirs)
+    crawl_stats = {}
+    for root_dir in args.crawl:
+        for archive_dir, entry_count, metadata_bytes in crawler.crawl(root_dir):
+            archive_dirs.append(archive_dir)
+            crawl_stats[archive_dir] = (entry_count, metadata_bytes)
+    return archive_dirs, len(archive_dirs), crawl_stats
+
+
+def _chain_crawls(archive_dirs, crawler, root_dirs):
+
+    """
+
+    Yield paths from the given iterable, then from crawling each root directory.
+
+    Parameters:
+        archive_dirs (iterable): Directory paths read from files or stdin.
+        crawler (DirectoryCrawler): The crawler to use.
+        root_dirs (list): Root directories to crawl.
+
+    Returns: Generator of directory paths.
+
+    """
+
+    yield from archive_dirs
+    for root_dir in root_dirs:
+        for archive_dir, _, _ in crawler.crawl(root_dir):
+            yield archive_dir
+
+
+if __name__ == "__main__":
+    sys.exit(main())
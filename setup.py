@@ -25,5 +25,11 @@ setuptools.setup(
     #],
     url="https://github.com/TheJacksonLaboratory/meta_mapper", 
     packages=setuptools.find_packages(),
-    python_requires='>=3.6',
+    entry_points={
+        "console_scripts": [
+            "meta-mapper=meta_mapper.cli:main",
+            "meta-mapper-client=meta_mapper.MappingClient:main",
+        ],
+    },
+    python_requires='>=3.7',
 )
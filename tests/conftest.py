@@ -0,0 +1,78 @@
+import json
+
+import pytest
+
+
+class FakeGroupsFinder:
+
+    """
+    Stands in for the live SystemGroupsFinder, with answers that depend only on the arguments.
+    """
+
+    def get_other_info_from_group(self, key, val, target_key):
+        return f"uid-{val}"
+
+    def get_groups_from_entire_doc(self, doc):
+        return [f"{doc['lab']}-grp"] if "lab" in doc else None
+
+    def search_archived_path_for_group_name(self, archived_path, target_key):
+        return [archived_path.rstrip("/").split("/")[-2]]
+
+
+def make_meta_doc(**fields):
+    meta_doc = {"grant_id": "G", "classification": "c", "manager_user_id": "m", "project_name": "p",
+                "source_folder_path": "/cifs/bht2stor.jax.org/q"}
+    meta_doc.update(fields)
+    return meta_doc
+
+
+FACULTY_DOCS = {
+    "x-lab/a": {"managerName": "xlab", "projectName": "Pa", "dataClassification": "NA", "lab": "x",
+                "meta_doc": make_meta_doc()},
+    # The same doc as a, so it's mapped from the memo.
+    "x-lab/a2": {"managerName": "xlab", "projectName": "Pa", "dataClassification": "NA", "lab": "x",
+                 "meta_doc": make_meta_doc()},
+    # No lab, so its groups come from its path.
+    "y-lab/b": {"managerName": "ylab", "projectName": "Pb", "source_size": 10,
+                "meta_doc": make_meta_doc(grant_id="H", manager_user_id="ylab", project_name="Pb")},
+    # Conflicting project names stop the mapping of the doc part way.
+    "y-lab/c": {"managerName": "zlab", "projectName": "Pc", "meta_doc": make_meta_doc(project_name="other")},
+}
+
+
+@pytest.fixture
+def archive(tmp_path):
+
+    """
+    A small faculty archive. Returns the list of directories holding metadata.
+    """
+
+    archive_dirs = []
+    for rel_dir, doc in FACULTY_DOCS.items():
+        archive_dir = tmp_path / "archive" / "faculty" / rel_dir
+        archive_dir.mkdir(parents=True)
+        (archive_dir / "metadata.json").write_text(json.dumps(doc))
+        (archive_dir / "data.bin").write_bytes(b"\0" * 5000)
+        archive_dirs.append(str(archive_dir))
+    return archive_dirs
+
+
+@pytest.fixture
+def make_mapper(tmp_path):
+
+    """
+    Build MetaMappers that treat the temporary archive like /archive/faculty.
+    """
+
+    pytest.importorskip("dateutil")
+    pytest.importorskip("system_groups_finder")
+    from meta_mapper.MetaMapper import MetaMapper
+
+    def make(**kwargs):
+        kwargs.setdefault("system_groups_finder", FakeGroupsFinder())
+        mapper = MetaMapper(**kwargs)
+        mapper.categories[str(tmp_path / "archive" / "faculty")] = "faculty"
+        mapper.archive_root = str(tmp_path / "archive")
+        return mapper
+
+    return make
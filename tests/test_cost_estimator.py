@@ -0,0 +1,59 @@
+import configparser
+import os
+
+import pytest
+
+from meta_mapper.CostEstimator import CostEstimator
+from meta_mapper.DirectoryCrawler import DirectoryCrawler
+
+
+@pytest.fixture
+def config():
+    # MetaMapper.get_config() needs system_groups_finder installed, so read the file directly.
+    config = configparser.ConfigParser()
+    config.read(os.path.join(os.path.dirname(__file__), "..", "meta_mapper", "meta_mapper_config.cfg"))
+    return config
+
+
+def make_tree(root, paths):
+    for path in paths:
+        full_path = root / path
+        full_path.parent.mkdir(parents=True, exist_ok=True)
+        full_path.write_text("{}")
+
+
+def test_crawl_counts_subtree_entries(tmp_path, config):
+    make_tree(tmp_path, [
+        "big/metadata.json",
+        "big/run1/reads/r1.fastq",
+        "big/run1/reads/r2.fastq",
+        "big/run2/r1.fastq",
+        "big/nested/metadata.json",
+        "big/nested/file",
+        "small/metadata.json",
+        "small/file",
+        "zz/metadata.json",
+    ])
+
+    found = list(DirectoryCrawler(config).crawl(str(tmp_path)))
+
+    assert [archive_dir for archive_dir, _, _ in found] == [
+        str(tmp_path / "big"), str(tmp_path / "big/nested"), str(tmp_path / "small"), str(tmp_path / "zz")]
+    entry_counts = {archive_dir: entry_count for archive_dir, entry_count, _ in found}
+    assert entry_counts[str(tmp_path / "big")] == 10
+    assert entry_counts[str(tmp_path / "big/nested")] == 2
+    assert entry_counts[str(tmp_path / "small")] == 2
+    assert entry_counts[str(tmp_path / "zz")] == 1
+    assert all(metadata_bytes == 2 for _, _, metadata_bytes in found)
+
+
+def test_order_puts_expensive_first(config):
+    crawl_stats = {"a": (10, 0), "b": (1000, 0), "c": (1, 0), "d": (100, 0)}
+    ordered = CostEstimator(config, crawl_stats=crawl_stats).order(["a", "b", "c", "d"])
+    assert ordered == ["b", "c", "d", "a"]
+
+
+def test_order_without_estimates_keeps_input_order(config):
+    archive_dirs = ["d", "a", "c", "b", "e"]
+    assert CostEstimator(config).order(archive_dirs) == archive_dirs
+    assert CostEstimator(config, archived_sizes={"x": 5}).order(archive_dirs) == archive_dirs
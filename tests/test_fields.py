@@ -0,0 +1,96 @@
+from itertools import combinations
+
+import pytest
+
+from conftest import FakeGroupsFinder
+from meta_mapper.GroupSnapshot import RecordingGroupsFinder, SnapshotGroupsFinder
+
+
+def get_partial(doc, fields):
+    return {key: val for key, val in doc.items() if key in fields}
+
+
+def check_fields_match_full_mapping(mapper, reference, archive_dirs):
+
+    field_names = mapper.get_field_names()
+    if mapper.group_snapshot_version_key not in field_names:
+        field_names.append(mapper.group_snapshot_version_key)
+
+    for archive_dir in archive_dirs:
+        full = reference.create_new_document(archive_dir)
+        assert isinstance(full, dict)
+
+        for num_fields in (1, 2):
+            for fields in combinations(field_names, num_fields):
+                assert mapper.create_new_document(archive_dir, fields=fields) == get_partial(full, fields), fields
+
+        assert mapper.lazy_document(archive_dir).to_dict() == full
+
+        for key in field_names:
+            lazy_doc = mapper.lazy_document(archive_dir)
+            assert (key in lazy_doc) == (key in full)
+            if key in full:
+                assert lazy_doc[key] == full[key]
+            else:
+                with pytest.raises(KeyError):
+                    lazy_doc[key]
+
+        lazy_doc = mapper.lazy_document(archive_dir)
+        assert list(lazy_doc) == list(full)
+        assert len(lazy_doc) == len(full)
+
+
+@pytest.mark.parametrize("memo_size", [0, 100])
+def test_fields_match_full_mapping(make_mapper, archive, memo_size):
+    check_fields_match_full_mapping(make_mapper(memo_size=memo_size), make_mapper(memo_size=0), archive)
+
+
+@pytest.fixture
+def snapshot_finder(make_mapper, archive, tmp_path):
+
+    """
+    A snapshot recorded over every directory but the last, whose lookups then miss.
+    """
+
+    recorder = RecordingGroupsFinder(FakeGroupsFinder())
+    recording_mapper = make_mapper(system_groups_finder=recorder)
+    for archive_dir in archive[:-1]:
+        recording_mapper.create_new_document(archive_dir)
+
+    filename = str(tmp_path / "groups.snap")
+    recorder.write(filename, "v1")
+    finder = SnapshotGroupsFinder(filename)
+    yield finder
+    finder.close()
+
+
+@pytest.mark.parametrize("memo_size", [0, 100])
+def test_fields_match_full_mapping_with_snapshot(make_mapper, archive, snapshot_finder, memo_size):
+    mapper = make_mapper(system_groups_finder=snapshot_finder, memo_size=memo_size)
+    reference = make_mapper(system_groups_finder=snapshot_finder, memo_size=0)
+    check_fields_match_full_mapping(mapper, reference, archive)
+
+
+def test_version_needs_lookups_that_hit(make_mapper, archive, snapshot_finder):
+    mapper = make_mapper(system_groups_finder=snapshot_finder)
+    hit_dir, missed_dir = archive[0], archive[-1]
+
+    assert mapper.create_new_document(hit_dir)["group_snapshot_version"] == "v1"
+    assert "group_snapshot_version" not in mapper.create_new_document(missed_dir)
+
+    # Asking for the version alone still runs, and checks, the lookups.
+    assert mapper.create_new_document(hit_dir, fields=["group_snapshot_version"]) == {"group_snapshot_version": "v1"}
+    assert mapper.create_new_document(missed_dir, fields=["group_snapshot_version"]) == {}
+    assert "group_snapshot_version" not in mapper.create_new_document(
+        missed_dir, fields=["archived_size", "group_snapshot_version"])
+
+    lazy_doc = mapper.lazy_document(missed_dir)
+    assert "group_snapshot_version" not in lazy_doc
+    assert "group_snapshot_version" not in lazy_doc.to_dict()
+    assert lazy_doc.get("group_snapshot_version") is None
+
+
+def test_version_without_snapshot_is_left_out(make_mapper, archive):
+    mapper = make_mapper()
+    assert mapper.create_new_document(archive[0], fields=["group_snapshot_version"]) == {}
+    assert "group_snapshot_version" not in mapper.lazy_document(archive[0])
@@ -0,0 +1,163 @@
+import threading
+
+import pytest
+
+from meta_mapper.GroupSnapshot import (SNAPSHOT_MAGIC, RecordingGroupsFinder, SnapshotGroupsFinder,
+                                       get_lookup_digest, write_snapshot)
+
+
+class FakeGroupsFinder:
+
+    def __init__(self):
+        self.num_calls = 0
+
+    def get_other_info_from_group(self, key, val, target_key):
+        self.num_calls += 1
+        return f"{target_key} of {val}"
+
+    def get_groups_from_entire_doc(self, doc):
+        self.num_calls += 1
+        return sorted(doc)
+
+    def search_archived_path_for_group_name(self, archived_path, target_key):
+        self.num_calls += 1
+        return archived_path.split("/")[-1]
+
+
+def write_lookups(filename, num_lookups):
+    lookups = {}
+    for i in range(num_lookups):
+        digest = get_lookup_digest("search_archived_path_for_group_name", f"/archive/{i}", "lab")
+        lookups[digest] = f'"lab{i}"'
+    write_snapshot(filename, lookups, "v1")
+
+
+def test_round_trip(tmp_path):
+    filename = str(tmp_path / "groups.snap")
+    live = FakeGroupsFinder()
+    recorder = RecordingGroupsFinder(live)
+    assert recorder.get_other_info_from_group("group", "g1", "manager") == "manager of g1"
+    assert recorder.get_groups_from_entire_doc({"b": 1, "a": 2}) == ["a", "b"]
+    assert recorder.search_archived_path_for_group_name("/archive/x-lab", "lab") == "x-lab"
+    assert recorder.write(filename, "2024-06") == 3
+
+    finder = SnapshotGroupsFinder(filename)
+    assert finder.snapshot_version == "2024-06"
+    assert finder.num_entries == 3
+    assert finder.get_other_info_from_group("group", "g1", "manager") == "manager of g1"
+    assert finder.get_groups_from_entire_doc({"b": 1, "a": 2}) == ["a", "b"]
+    assert finder.search_archived_path_for_group_name("/archive/x-lab", "lab") == "x-lab"
+    assert finder.num_misses == 0
+    assert live.num_calls == 3
+    finder.close()
+
+
+def test_key_order_matters(tmp_path):
+    filename = str(tmp_path / "groups.snap")
+    recorder = RecordingGroupsFinder(FakeGroupsFinder())
+    recorder.get_groups_from_entire_doc({"b": 1, "a": 2})
+    recorder.write(filename, "v1")
+
+    assert (get_lookup_digest("get_groups_from_entire_doc", {"b": 1, "a": 2})
+            != get_lookup_digest("get_groups_from_entire_doc", {"a": 2, "b": 1}))
+
+    finder = SnapshotGroupsFinder(filename)
+    assert finder.get_groups_from_entire_doc({"b": 1, "a": 2}) == ["a", "b"]
+    assert finder.get_groups_from_entire_doc({"a": 2, "b": 1}) is None
+    assert finder.num_misses == 1
+    finder.close()
+
+
+def test_non_json_arguments_are_rejected():
+    with pytest.raises(TypeError, match="non-json"):
+        get_lookup_digest("get_groups_from_entire_doc", {"a": {1, 2}})
+
+    # Rather than str() of the argument, which could match a different lookup.
+    with pytest.raises(TypeError, match="non-json"):
+        get_lookup_digest("search_archived_path_for_group_name", object(), "lab")
+
+    live = FakeGroupsFinder()
+    recorder = RecordingGroupsFinder(live)
+    with pytest.raises(TypeError, match="non-json"):
+        recorder.get_groups_from_entire_doc({"a": {1, 2}})
+    assert live.num_calls == 0
+    assert recorder.lookups == {}
+
+
+def test_binary_search_hit_and_miss(tmp_path):
+    filename = str(tmp_path / "groups.snap")
+    write_lookups(filename, 1000)
+
+    finder = SnapshotGroupsFinder(filename)
+    for i in range(1000):
+        assert finder.search_archived_path_for_group_name(f"/archive/{i}", "lab") == f"lab{i}"
+    assert finder.num_misses == 0
+
+    assert finder.search_archived_path_for_group_name("/archive/1000", "lab") is None
+    assert finder.search_archived_path_for_group_name("/archive/1", "manager") is None
+    assert finder.num_misses == 2
+    assert finder.get_thread_misses() == 2
+    finder.close()
+
+
+def test_empty_snapshot(tmp_path):
+    filename = str(tmp_path / "groups.snap")
+    write_lookups(filename, 0)
+
+    finder = SnapshotGroupsFinder(filename)
+    assert finder.search_archived_path_for_group_name("/archive/0", "lab") is None
+    assert finder.num_misses == 1
+    finder.close()
+
+
+def test_misses_are_counted_per_thread(tmp_path):
+    filename = str(tmp_path / "groups.snap")
+    write_lookups(filename, 10)
+    finder = SnapshotGroupsFinder(filename)
+
+    thread_misses = []
+
+    def look_up():
+        finder.search_archived_path_for_group_name("/archive/missing", "lab")
+        finder.search_archived_path_for_group_name("/archive/1", "lab")
+        thread_misses.append(finder.get_thread_misses())
+
+    threads = [threading.Thread(target=look_up) for _ in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert thread_misses == [1, 1, 1, 1]
+    assert finder.get_thread_misses() == 0
+    assert finder.num_misses == 4
+    finder.close()
+
+
+def test_bad_magic(tmp_path):
+    filename = tmp_path / "groups.snap"
+    filename.write_bytes(b"NOTASNAP" + b"\0" * 64)
+    with pytest.raises(ValueError, match="Not a group snapshot"):
+        SnapshotGroupsFinder(str(filename))
+
+
+def test_bad_header(tmp_path):
+    filename = tmp_path / "groups.snap"
+    header = b'{"snapshot_version": "v1"}'
+    filename.write_bytes(SNAPSHOT_MAGIC + len(header).to_bytes(4, "little") + header)
+    with pytest.raises(ValueError, match="Bad header"):
+        SnapshotGroupsFinder(str(filename))
+
+    filename.write_bytes(SNAPSHOT_MAGIC + (5).to_bytes(4, "little") + b"{nope")
+    with pytest.raises(ValueError, match="Bad header"):
+        SnapshotGroupsFinder(str(filename))
+
+
+@pytest.mark.parametrize("num_bytes_cut", [1, 20, 100])
+def test_truncated_file(tmp_path, num_bytes_cut):
+    filename = tmp_path / "groups.snap"
+    write_lookups(str(filename), 10)
+    data = filename.read_bytes()
+    filename.write_bytes(data[:-num_bytes_cut])
+    with pytest.raises(ValueError, match="truncated"):
+        SnapshotGroupsFinder(str(filename))
@@ -0,0 +1,145 @@
+import configparser
+import multiprocessing
+import os
+import signal
+import threading
+import time
+
+import pytest
+
+from meta_mapper.IoScheduler import AdaptiveLimiter, IoScheduler, SharedMountLimits
+
+
+@pytest.fixture
+def config():
+    config = configparser.ConfigParser()
+    config.read(os.path.join(os.path.dirname(__file__), "..", "meta_mapper", "meta_mapper_config.cfg"))
+    config["io_mounts"] = {"/archive": "3"}
+    config["io_scheduler"]["walk_concurrency"] = "2"
+    return config
+
+
+def hold_operations(shared_limits, num_threads, in_flight, peak, seconds):
+
+    def work():
+        slot = shared_limits.acquire("/archive")
+        with in_flight.get_lock():
+            in_flight.value += 1
+            peak.value = max(peak.value, in_flight.value)
+        time.sleep(seconds)
+        with in_flight.get_lock():
+            in_flight.value -= 1
+        shared_limits.release("/archive", slot)
+
+    threads = [threading.Thread(target=work) for _ in range(num_threads)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+
+def hold_walks_forever(shared_limits, ready):
+    for _ in range(shared_limits.walk_limit):
+        shared_limits.acquire("/archive", walk=True)
+    ready.set()
+    time.sleep(60)
+
+
+def slow_operation(shared_limits):
+    slot = shared_limits.acquire("/archive")
+    shared_limits.release("/archive", slot, latency=10.0, ok=True)
+
+
+def test_limit_caps_every_process_together(config):
+    shared_limits = SharedMountLimits(config)
+    in_flight = multiprocessing.Value("i", 0)
+    peak = multiprocessing.Value("i", 0)
+
+    processes = [multiprocessing.Process(target=hold_operations,
+                                         args=(shared_limits, 3, in_flight, peak, 0.05))
+                 for _ in range(4)]
+    for process in processes:
+        process.start()
+    for process in processes:
+        process.join(timeout=30)
+        assert process.exitcode == 0
+
+    assert peak.value == 3
+
+
+def test_slots_of_a_killed_process_are_freed(config):
+    shared_limits = SharedMountLimits(config)
+    ready = multiprocessing.Event()
+
+    for _ in range(3):
+        process = multiprocessing.Process(target=hold_walks_forever, args=(shared_limits, ready))
+        process.start()
+        assert ready.wait(timeout=10)
+        os.kill(process.pid, signal.SIGKILL)
+        process.join()
+        ready.clear()
+
+    slots = []
+    waiter = threading.Thread(target=lambda: slots.extend(
+        shared_limits.acquire("/archive", walk=True) for _ in range(2)))
+    waiter.start()
+    waiter.join(timeout=5)
+    assert not waiter.is_alive()
+    assert sorted(slots) == [0, 1]
+
+
+def test_shared_limit_adapts_across_processes(config):
+    shared_limits = SharedMountLimits(config)
+    assert shared_limits.get_limit("/archive") == 3.0
+
+    process = multiprocessing.Process(target=slow_operation, args=(shared_limits,))
+    process.start()
+    process.join(timeout=10)
+    assert process.exitcode == 0
+    assert shared_limits.get_limit("/archive") == 1.5
+
+    for _ in range(20):
+        slot = shared_limits.acquire("/archive")
+        shared_limits.release("/archive", slot, latency=0.0, ok=True)
+    assert shared_limits.get_limit("/archive") > 3.0
+
+
+def test_threads_of_one_process_get_separate_slots(config):
+    shared_limits = SharedMountLimits(config)
+    slots = [shared_limits.acquire("/archive") for _ in range(3)]
+    assert sorted(slots) == [0, 1, 2]
+
+    acquired = threading.Event()
+    thread = threading.Thread(target=lambda: (shared_limits.acquire("/archive"), acquired.set()))
+    thread.start()
+    assert not acquired.wait(timeout=0.2)
+    shared_limits.release("/archive", slots[0])
+    assert acquired.wait(timeout=5)
+    thread.join()
+
+
+def test_scheduler_reports_the_shared_limit(config):
+    scheduler = IoScheduler(config, shared_limits=SharedMountLimits(config))
+    assert scheduler.run("/archive/x", lambda: 42) == 42
+    assert scheduler.run_walk("/archive/x", lambda: 7) == 7
+    assert scheduler.get_stats()["/archive"]["limit"] == 3
+    assert scheduler.get_stats()["/archive"]["completed"] == 1
+
+
+def test_directory_is_removed(config):
+    shared_limits = SharedMountLimits(config)
+    directory = shared_limits.directory
+    assert os.path.isdir(directory)
+    del shared_limits
+    assert not os.path.exists(directory)
+
+
+def test_adaptive_limiter_backs_off_and_recovers():
+    limiter = AdaptiveLimiter(8, 1, 16, target_latency=0.5)
+    limiter.acquire()
+    limiter.release(2.0, True)
+    assert limiter.get_stats()["limit"] == 4
+    for _ in range(40):
+        limiter.acquire()
+        limiter.release(0.01, True)
+    assert limiter.get_stats()["limit"] > 4
@@ -0,0 +1,81 @@
+import json
+import tracemalloc
+
+import pytest
+
+# MappedRecord reads the template through MetaMapper, which needs these.
+pytest.importorskip("dateutil")
+pytest.importorskip("system_groups_finder")
+
+from meta_mapper.MappedRecord import MappedRecordBatch, get_record_class
+
+
+def make_docs(num_docs):
+
+    """
+    Documents shaped like mapped ones, parsed fresh from json like those read from a store.
+    """
+
+    docs = []
+    for i in range(num_docs):
+        lab = f"lab{i % 20}"
+        doc = {"manager_user_id": f"pi{i % 20}", "user_id": f"user{i % 50}", "project_name": f"Project {i}",
+               "classification": "internal", "grant_id": "NA", "notes": "", "system_groups": [lab, "users"],
+               "archived_path": f"/archive/faculty/{lab}/dir{i}", "source_path": f"/cifs/{lab}/dir{i}",
+               "archival_status": "completed", "archived_size": 1000 + i, "date_archived": "2021-03-04",
+               "source_size": None, "user_metadata": {"project": {"pi": f"pi{i % 20}", "notes": "n"}}}
+        docs.append(json.loads(json.dumps(doc)))
+    return docs
+
+
+def test_batch_round_trips_mapped_docs(make_mapper, archive):
+    mapper = make_mapper()
+    docs = [mapper.create_new_document(archive_dir) for archive_dir in archive]
+    docs = [doc for doc in docs if isinstance(doc, dict)]
+    assert docs
+
+    batch = MappedRecordBatch(docs)
+    assert len(batch) == len(docs)
+    assert list(batch) == docs
+    assert [batch[i] for i in range(len(batch))] == docs
+    assert [record.to_dict() for record in batch.records] == docs
+
+
+def test_returned_docs_dont_share_the_records_lists():
+    doc = make_docs(1)[0]
+    batch = MappedRecordBatch([doc])
+
+    doc["system_groups"].append("from-input")
+    batch[0]["system_groups"].append("from-getitem")
+    next(iter(batch))["user_metadata"]["project"] = None
+    batch.records[0].to_dict()["system_groups"].clear()
+
+    assert batch[0] == make_docs(1)[0]
+
+
+def test_record_class_has_every_template_key():
+    record_class = get_record_class()
+    assert "archived_path" in record_class.template_keys
+    assert record_class.template_keys[-1] == "group_snapshot_version"
+
+
+def test_batch_takes_less_than_half_the_memory_of_dicts():
+    num_docs = 5000
+
+    tracemalloc.start()
+    try:
+        docs = make_docs(num_docs)
+        docs_size = tracemalloc.get_traced_memory()[0]
+        del docs
+
+        tracemalloc.reset_peak()
+        start = tracemalloc.get_traced_memory()[0]
+        batch = MappedRecordBatch()
+        for doc in make_docs(num_docs):
+            batch.append(doc)
+        batch_size = tracemalloc.get_traced_memory()[0] - start
+    finally:
+        tracemalloc.stop()
+
+    assert len(batch) == num_docs
+    assert batch_size < 0.5 * docs_size
@@ -0,0 +1,79 @@
+from meta_mapper.MappingMemo import MappingMemo, get_doc_digest
+
+
+def get_containers(doc):
+    return [val for val in doc.values() if isinstance(val, (list, dict))]
+
+
+def test_least_recently_used_is_forgotten():
+    memo = MappingMemo(2)
+    memo.put("a", 1)
+    memo.put("b", 2)
+    assert memo.get("a") == 1
+    memo.put("c", 3)
+
+    assert memo.get("b") is None
+    assert memo.get("a") == 1
+    assert memo.get("c") == 3
+    assert memo.get_stats() == {"hits": 3, "misses": 1, "entries": 2}
+
+
+def test_doc_digest_keeps_key_order():
+    assert get_doc_digest({"a": 1, "b": [2]}) == get_doc_digest({"a": 1, "b": [2]})
+    assert get_doc_digest({"a": 1, "b": [2]}) != get_doc_digest({"b": [2], "a": 1})
+
+
+def test_hit_returns_the_same_doc_as_a_miss(make_mapper, archive):
+    mapper = make_mapper(memo_size=100)
+    reference = make_mapper(memo_size=0)
+    first_dir, same_dir = archive[0], archive[1]
+
+    assert mapper.create_new_document(first_dir) == reference.create_new_document(first_dir)
+    assert mapper.create_new_document(same_dir) == reference.create_new_document(same_dir)
+    assert mapper.create_new_document(first_dir) == reference.create_new_document(first_dir)
+    assert mapper.memo.get_stats() == {"hits": 2, "misses": 1, "entries": 1}
+
+    # Docs that differ aren't mapped from the memo.
+    for archive_dir in archive[2:]:
+        assert mapper.create_new_document(archive_dir) == reference.create_new_document(archive_dir)
+    assert mapper.memo.get_stats()["hits"] == 2
+
+
+def test_docs_dont_share_objects_with_the_memo(make_mapper, archive):
+    mapper = make_mapper(memo_size=100)
+    reference = make_mapper(memo_size=0).create_new_document(archive[1])
+    first = mapper.create_new_document(archive[0])
+    second = mapper.create_new_document(archive[1])
+
+    memo_doc = next(iter(mapper.memo.entries.values()))[0]
+    first_ids = {id(val) for val in get_containers(first)}
+    second_ids = {id(val) for val in get_containers(second)}
+    memo_ids = {id(val) for val in get_containers(memo_doc)}
+    assert first_ids and second_ids and memo_ids
+    assert not first_ids & second_ids
+    assert not first_ids & memo_ids
+    assert not second_ids & memo_ids
+
+    # Changing a returned doc changes neither the memo nor later hits.
+    for val in get_containers(first) + get_containers(second):
+        val.clear()
+    assert mapper.create_new_document(archive[1]) == reference
+
+
+def test_hit_gets_its_own_user_metadata(make_mapper, archive):
+    mapper = make_mapper(memo_size=100)
+    first = mapper.create_new_document(archive[0])
+    second = mapper.create_new_document(archive[1])
+    assert mapper.memo.get_stats()["hits"] == 1
+
+    reference = make_mapper(memo_size=0).create_new_document(archive[1])
+    assert second["user_metadata"] == reference["user_metadata"]
+    assert second["user_metadata"] is not first["user_metadata"]
+
+    # It's rebuilt from this directory's own doc on every hit.
+    first["user_metadata"]["manager_name"] = "changed"
+    assert mapper.create_new_document(archive[1])["user_metadata"] == reference["user_metadata"]
+
+    # The memo doesn't hold on to a whole metadata doc.
+    memo_doc = next(iter(mapper.memo.entries.values()))[0]
+    assert memo_doc["user_metadata"] is None
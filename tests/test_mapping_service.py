@@ -0,0 +1,43 @@
+import os
+import socket
+import stat
+
+import pytest
+
+# The service builds MetaMappers, which need these.
+pytest.importorskip("dateutil")
+pytest.importorskip("system_groups_finder")
+
+from meta_mapper.MappingService import MappingService
+
+
+def test_refuses_a_regular_file(tmp_path):
+    socket_path = tmp_path / "service.sock"
+    socket_path.write_text("keep me")
+
+    with pytest.raises(RuntimeError, match="not a socket"):
+        MappingService(str(socket_path)).serve_forever()
+    assert socket_path.read_text() == "keep me"
+
+
+def test_refuses_a_live_socket(tmp_path):
+    socket_path = str(tmp_path / "service.sock")
+    listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    listener.bind(socket_path)
+    listener.listen(1)
+    try:
+        with pytest.raises(RuntimeError, match="already listening"):
+            MappingService(socket_path).serve_forever()
+        assert stat.S_ISSOCK(os.lstat(socket_path).st_mode)
+    finally:
+        listener.close()
+
+
+def test_removes_a_stale_socket(tmp_path):
+    socket_path = str(tmp_path / "service.sock")
+    listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    listener.bind(socket_path)
+    listener.close()
+
+    MappingService(socket_path)._MappingService__remove_stale_socket()
+    assert not os.path.exists(socket_path)
@@ -0,0 +1,274 @@
+import json
+import sqlite3
+import threading
+import time
+
+import pytest
+
+from meta_mapper.DeltaIndex import DeltaIndex, DeltaSink
+from meta_mapper.UpsertSink import BulkUpsertSink, MongoUpsertSink, SqliteUpsertSink
+
+
+def make_doc(i, **fields):
+    doc = {"archived_path": f"/archive/{i}", "archived_size": i}
+    doc.update(fields)
+    return doc
+
+
+def read_table(filename, table="metadata"):
+    conn = sqlite3.connect(filename)
+    try:
+        return {key: json.loads(doc) for key, doc in conn.execute(f"SELECT key, doc FROM {table}")}
+    finally:
+        conn.close()
+
+
+class FlakySqliteSink(SqliteUpsertSink):
+
+    """
+    Fails the first attempt at each batch after writing it, like a connection lost before the
+    store's acknowledgement arrives.
+    """
+
+    def __init__(self, *args, **kwargs):
+        self.attempted = set()
+        super().__init__(*args, **kwargs)
+
+    def _upsert_batch(self, records):
+        super()._upsert_batch(records)
+        batch_key = records[0][0]
+        if batch_key not in self.attempted:
+            self.attempted.add(batch_key)
+            raise sqlite3.OperationalError("database is locked")
+
+
+class BrokenSink(BulkUpsertSink):
+
+    def _upsert_batch(self, records):
+        raise ValueError("store rejected the batch")
+
+
+class GatedSink(BulkUpsertSink):
+
+    """
+    Holds every batch until the test lets it through.
+    """
+
+    def __init__(self, **kwargs):
+        self.gate = threading.Event()
+        self.written = []
+        super().__init__(**kwargs)
+
+    def _upsert_batch(self, records):
+        self.gate.wait()
+        self.written.extend(key for key, _ in records)
+
+
+def test_sqlite_batches(tmp_path):
+    filename = str(tmp_path / "store.db")
+    sink = SqliteUpsertSink(filename, batch_size=10, flush_interval=60)
+    for i in range(25):
+        sink.write(f"/archive/{i}", make_doc(i))
+    sink.close()
+
+    assert sink.num_written == 25
+    assert sink.num_batches == 3
+    assert read_table(filename) == {f"/archive/{i}": make_doc(i) for i in range(25)}
+
+
+def test_sqlite_dedupes_and_replaces(tmp_path):
+    filename = str(tmp_path / "store.db")
+    with SqliteUpsertSink(filename, table="docs", batch_size=100) as sink:
+        sink.write("/archive/1", make_doc(1, status="old"))
+        sink.write("/archive/1", make_doc(1, status="new"))
+    assert sink.num_written == 1
+
+    with SqliteUpsertSink(filename, table="docs") as sink:
+        sink.write("/archive/1", make_doc(1, status="newer"))
+        sink.write("/archive/2", make_doc(2))
+    assert read_table(filename, "docs") == {"/archive/1": make_doc(1, status="newer"),
+                                            "/archive/2": make_doc(2)}
+
+
+def test_sqlite_rejects_bad_table(tmp_path):
+    with pytest.raises(ValueError):
+        SqliteUpsertSink(str(tmp_path / "store.db"), table="docs; DROP TABLE x")
+
+
+def test_retry_does_not_duplicate(tmp_path):
+    filename = str(tmp_path / "store.db")
+    sink = FlakySqliteSink(filename, batch_size=5, retry_delay=0.001)
+    for i in range(12):
+        sink.write(f"/archive/{i}", make_doc(i))
+    sink.close()
+
+    assert sink.num_retries == 3
+    assert sink.num_written == 12
+    conn = sqlite3.connect(filename)
+    assert conn.execute("SELECT COUNT(*) FROM metadata").fetchone()[0] == 12
+    conn.close()
+
+
+def test_failure_is_raised(tmp_path):
+    sink = BrokenSink(batch_size=2)
+    sink.write("/archive/1", make_doc(1))
+    sink.write("/archive/2", make_doc(2))
+    with pytest.raises(RuntimeError, match="store rejected"):
+        sink.flush()
+    with pytest.raises(RuntimeError):
+        sink.write("/archive/3", make_doc(3))
+    with pytest.raises(RuntimeError):
+        sink.close()
+
+
+def test_backpressure_blocks_write():
+    sink = GatedSink(batch_size=1, max_pending_batches=1, flush_interval=60)
+    sink.write("/archive/0", make_doc(0))   # taken by the writer, which waits on the gate
+    time.sleep(0.05)
+    sink.write("/archive/1", make_doc(1))   # pending
+
+    blocked = threading.Thread(target=sink.write, args=("/archive/2", make_doc(2)))
+    blocked.start()
+    blocked.join(timeout=0.2)
+    assert blocked.is_alive()
+
+    sink.gate.set()
+    blocked.join(timeout=5)
+    assert not blocked.is_alive()
+    sink.close()
+
+    assert sink.written == ["/archive/0", "/archive/1", "/archive/2"]
+    assert sink.seconds_blocked >= 0.1
+
+
+def test_partial_batch_is_flushed_on_a_timer(tmp_path):
+    filename = str(tmp_path / "store.db")
+    sink = SqliteUpsertSink(filename, batch_size=100, flush_interval=0.1)
+    sink.write("/archive/1", make_doc(1))
+
+    deadline = time.monotonic() + 5
+    while not read_table(filename) and time.monotonic() < deadline:
+        time.sleep(0.02)
+    assert read_table(filename) == {"/archive/1": make_doc(1)}
+    sink.close()
+
+
+def test_flush_waits_for_the_store(tmp_path):
+    filename = str(tmp_path / "store.db")
+    sink = SqliteUpsertSink(filename, batch_size=100, flush_interval=60)
+    for i in range(3):
+        sink.write(f"/archive/{i}", make_doc(i))
+    sink.flush()
+    assert len(read_table(filename)) == 3
+    sink.close()
+
+
+def test_delta_updates(tmp_path):
+    filename = str(tmp_path / "store.db")
+    index_filename = str(tmp_path / "index.db")
+
+    with DeltaSink(SqliteUpsertSink(filename), DeltaIndex(index_filename)) as sink:
+        sink.write("/archive/1", make_doc(1, status="new", notes="n"))
+        sink.write("/archive/2", make_doc(2))
+    assert sink.num_inserted == 2
+
+    with DeltaSink(SqliteUpsertSink(filename), DeltaIndex(index_filename)) as sink:
+        sink.write("/archive/1", make_doc(1, status="done"))
+        sink.write("/archive/2", make_doc(2))
+    assert (sink.num_inserted, sink.num_updated, sink.num_unchanged) == (0, 1, 1)
+
+    assert read_table(filename) == {"/archive/1": make_doc(1, status="done"), "/archive/2": make_doc(2)}
+
+
+def test_delta_index_not_committed_when_store_fails(tmp_path):
+    index_filename = str(tmp_path / "index.db")
+
+    sink = DeltaSink(BrokenSink(batch_size=1), DeltaIndex(index_filename))
+    with pytest.raises(RuntimeError):
+        with sink:
+            sink.write("/archive/1", make_doc(1))
+            time.sleep(0.05)
+            sink.write("/archive/2", make_doc(2))
+
+    # Neither document was stored, so both are still new to the index.
+    delta_index = DeltaIndex(index_filename)
+    assert delta_index.get_delta("/archive/1", make_doc(1))["op"] == "insert"
+    assert delta_index.get_delta("/archive/2", make_doc(2))["op"] == "insert"
+    delta_index.close(commit=False)
+
+
+def test_delta_index_committed_in_intervals(tmp_path):
+    filename = str(tmp_path / "store.db")
+    index_filename = str(tmp_path / "index.db")
+
+    sink = DeltaSink(SqliteUpsertSink(filename, flush_interval=60), DeltaIndex(index_filename),
+                     commit_interval=2)
+    for i in range(3):
+        sink.write(f"/archive/{i}", make_doc(i))
+
+    # The first two were flushed to the store and committed. The third is still pending.
+    assert len(read_table(filename)) == 2
+    conn = sqlite3.connect(index_filename)
+    assert conn.execute("SELECT COUNT(*) FROM docs").fetchone()[0] == 2
+    conn.close()
+    sink.close()
+
+
+def test_delta_index_archived_sizes(tmp_path):
+    delta_index = DeltaIndex(str(tmp_path / "index.db"))
+    delta_index.get_delta("/archive/1", make_doc(1))
+    delta_index.get_delta("/archive/2", make_doc(2, archived_size=None))
+    delta_index.get_delta("/archive/3", make_doc(3, archived_size="3 GB"))
+    delta_index.get_delta("/archive/4", {"archived_path": "/archive/4"})
+    delta_index.get_delta("/archive/5", make_doc(5, archived_size=True))
+    delta_index.get_delta("/archive/6", make_doc(6, size=60))
+
+    assert delta_index.get_archived_sizes() == {"/archive/1": 1, "/archive/6": 6}
+    assert delta_index.get_archived_sizes("size") == {"/archive/6": 60}
+    delta_index.close()
+
+
+@pytest.fixture
+def mongo_collection(monkeypatch):
+    pymongo = pytest.importorskip("pymongo")
+    mongomock = pytest.importorskip("mongomock")
+    client = mongomock.MongoClient()
+    monkeypatch.setattr(pymongo, "MongoClient", lambda uri: client)
+    return client["meta_mapper_test"]["metadata"]
+
+
+def test_mongo_batches_and_updates(mongo_collection):
+    with MongoUpsertSink("mongodb://localhost", database="meta_mapper_test", batch_size=10) as sink:
+        for i in range(25):
+            sink.write(f"/archive/{i}", make_doc(i))
+    assert sink.num_batches == 3
+    assert mongo_collection.count_documents({}) == 25
+
+    with MongoUpsertSink("mongodb://localhost", database="meta_mapper_test") as sink:
+        sink.write("/archive/1", {"op": "update", "archived_path": "/archive/1",
+                                  "set": {"status": "done"}, "unset": ["archived_size"]})
+        sink.write("/archive/100", {"op": "insert", "archived_path": "/archive/100",
+                                    "doc": make_doc(100)})
+
+    doc = mongo_collection.find_one({"archived_path": "/archive/1"}, {"_id": False})
+    assert doc == {"archived_path": "/archive/1", "status": "done"}
+    assert mongo_collection.count_documents({}) == 26
+
+
+def test_mongo_retry_does_not_duplicate(mongo_collection):
+    import pymongo
+
+    class FlakyMongoSink(MongoUpsertSink):
+        failed = False
+
+        def _upsert_batch(self, records):
+            super()._upsert_batch(records)
+            if not self.failed:
+                self.failed = True
+                raise pymongo.errors.AutoReconnect("connection lost")
+
+    with FlakyMongoSink("mongodb://localhost", database="meta_mapper_test", retry_delay=0.001) as sink:
+        for i in range(5):
+            sink.write(f"/archive/{i}", make_doc(i))
+    assert sink.num_retries == 1
+    assert mongo_collection.count_documents({}) == 5